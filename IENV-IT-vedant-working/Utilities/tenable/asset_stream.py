@@ -0,0 +1,111 @@
+#! /usr/bin/python3
+
+import csv
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+
+from findings import FindingStore
+
+# findings held in memory before partial groups are spilled to disk
+DEFAULT_MAX_ROWS = 100000
+# number of spill files; any that end up larger than max_rows are split again
+DEFAULT_BUCKETS = 64
+
+SPILL_FIELDS = ["IP Address", "NetBIOS Name", "DNS Name", "MAC Address", "Plugin", "Severity", "Plugin Name"]
+
+
+def read_assets(filename):
+    return FindingStore.from_csv(filename)
+
+
+def plugin_ids(filename):
+    # distinct plugin ids of an export without grouping it
+    with open(filename, "r", newline="") as file:
+        reader = csv.reader(file)
+        column = next(reader).index("Plugin")
+        return {row[column] for row in reader if row}
+
+
+def iter_assets(filename, max_rows=DEFAULT_MAX_ROWS, buckets=DEFAULT_BUCKETS, spill_dir=None):
+    # Yields assets one at a time while holding at most max_rows findings in memory.
+    # Once the budget is hit, partial groups are appended to spill files partitioned
+    # by IP so every asset lands in exactly one file; each file is then regrouped on
+    # its own and its assets are yielded before the next file is read. A file that
+    # grew past max_rows is split again with a different hash before it is loaded.
+    workdir = tempfile.mkdtemp(prefix="tenable-spill-", dir=spill_dir)
+    spill_paths = [os.path.join(workdir, "bucket-%03d.csv" % n) for n in range(buckets)]
+    counts = {}  # spill path -> findings written to it
+    try:
+        store = FindingStore()
+        with open(filename, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                store.add(row)
+                if len(store) >= max_rows:
+                    spill(store.rows(), spill_paths, counts)
+                    store = FindingStore()
+
+        if not counts:
+            yield from store
+            return
+
+        spill(store.rows(), spill_paths, counts)
+        del store
+        yield from regroup(spill_paths, counts, max_rows)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def regroup(spill_paths, counts, max_rows, depth=0):
+    for path in spill_paths:
+        if path not in counts:
+            continue
+        if counts[path] > max_rows:
+            # at least twice as many parts as needed so uneven hashing still leaves
+            # each one under budget
+            parts = 2 * -(-counts[path] // max_rows)
+            part_paths = ["%s.%d" % (path, n) for n in range(parts)]
+            part_counts = {}
+            with open(path, "r", newline="") as file:
+                spill(csv.reader(file), part_paths, part_counts, seed=depth + 1)
+            os.remove(path)
+            if len(part_counts) > 1:
+                yield from regroup(part_paths, part_counts, max_rows, depth + 1)
+                continue
+            # every row hashed to the same part: a single host with more than max_rows
+            # findings, which has to be loaded whole anyway
+            path = next(iter(part_counts))
+
+        with open(path, "r", newline="") as file:
+            bucket = FindingStore.from_rows(csv.DictReader(file, fieldnames=SPILL_FIELDS))
+        os.remove(path)
+        yield from bucket
+
+
+def bucket_of(ip, buckets, seed=0):
+    if not seed:
+        return zlib.crc32(ip.encode()) % buckets
+    # crc32 with another initial value only xors a constant into equal-length inputs,
+    # which would keep the rows of an oversized bucket together, so re-partitioning
+    # uses a salted hash instead
+    digest = hashlib.blake2b(ip.encode(), digest_size=4, salt=str(seed).encode()).digest()
+    return int.from_bytes(digest, "big") % buckets
+
+
+def spill(rows, spill_paths, counts, seed=0):
+    writers = {}
+    files = []
+    try:
+        for row in rows:
+            path = spill_paths[bucket_of(row[0], len(spill_paths), seed)]
+            if path not in writers:
+                file = open(path, "a", newline="")
+                files.append(file)
+                writers[path] = csv.writer(file)
+            writers[path].writerow(row)
+            counts[path] = counts.get(path, 0) + 1
+    finally:
+        for file in files:
+            file.close()
@@ -0,0 +1,58 @@
+#! /usr/bin/python3
+
+import base64
+import json
+import os
+import tempfile
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+SALT_SIZE = 16
+KDF_ITERATIONS = 390000
+
+
+class EncryptedCookieJar:
+    """Session cookies persisted between runs, encrypted with a key derived from the account password.
+
+    The file is a random salt followed by a Fernet token; a wrong password, a
+    corrupted file or a missing one all just mean "log in again".
+    """
+
+    def __init__(self, path, password):
+        self.path = path
+        self.password = password.encode()
+
+    def key(self, salt):
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS)
+        return base64.urlsafe_b64encode(kdf.derive(self.password))
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+            salt, token = data[:SALT_SIZE], data[SALT_SIZE:]
+            return json.loads(Fernet(self.key(salt)).decrypt(token))
+        except (OSError, ValueError, InvalidToken):
+            return None
+
+    def save(self, state):
+        salt = os.urandom(SALT_SIZE)
+        token = Fernet(self.key(salt)).encrypt(json.dumps(state).encode())
+        # written next to the target and renamed so a crash never leaves half a jar behind;
+        # mkstemp creates the file readable by its owner only
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".cookies-")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(salt + token)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
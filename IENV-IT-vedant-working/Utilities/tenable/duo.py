@@ -11,17 +11,18 @@ from selenium.webdriver.firefox.options import Options
 
 
 class MyNetworkDuoLogin:
-    def __init__(self, username, password, environment="production"):
+    def __init__(self, username, password, environment="production", headless=False):
         self.username = username
         self.password = password
         self.cookies = None
-        self.driver = self.start_firefox()
+        self.driver = self.start_firefox(headless)
         self.environment = environment
         self.login(self.username, self.password)
 
-    def start_firefox(self):
+    def start_firefox(self, headless=False):
         options = Options()
-        options.headless = False
+        # the Duo push is accepted on the phone, so nothing has to be clicked in the browser
+        options.headless = headless
 
         logging.info("Starting firefox and loading mynetwork")
         binary = FirefoxBinary("/Applications/Firefox.app/Contents/MacOS/firefox-bin")
@@ -42,12 +43,11 @@ class MyNetworkDuoLogin:
         self.driver.find_element(By.NAME, "submit").click()
 
         if self.environment == "production":
-            time.sleep(5)
-            duo_iframe = self.driver.find_element(By.ID, "duo_iframe")
+            duo_iframe = WebDriverWait(self.driver, 30).until(
+                EC.presence_of_element_located((By.ID, "duo_iframe"))
+            )
             if duo_iframe:
-                self.driver.switch_to.frame(
-                    self.driver.find_element(By.ID, "duo_iframe")
-                )
+                self.driver.switch_to.frame(duo_iframe)
 
                 logging.warning("Remember! Don't accept this DUO push")
                 logging.info("Waiting for DUO iframe to load")
@@ -83,3 +83,13 @@ class MyNetworkDuoLogin:
     def get(self, url):
         self.driver.get(url)
         return self.driver.page_source
+
+    def close(self):
+        self.driver.quit()
+
+    def export_cookies(self):
+        # the authenticated session's cookies, for plain HTTP clients
+        return self.driver.get_cookies()
+
+    def user_agent(self):
+        return self.driver.execute_script("return navigator.userAgent")
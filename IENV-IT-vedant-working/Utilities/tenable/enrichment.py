@@ -0,0 +1,113 @@
+#! /usr/bin/python3
+
+import concurrent.futures
+import logging
+import os
+
+from http_session import pooled_session
+from snapshot_cache import MISSING
+
+COEITADMIN_URL = "https://coeitadmin.engr.ucdavis.edu/api/ucomputer/"
+UCDNETWORK_URL = "https://ucdnetwork.engr.ucdavis.edu/devices"
+
+
+def enrichment_session(pool_size):
+    # one keep-alive pool per API host, sized for every worker
+    return pooled_session(pool_size, pool_connections=2)
+
+
+def get_ad_computer_info(hostname, session):
+    headers = {"coe-api-key": os.environ["API_KEY_COEITADMIN_TOOLS"]}
+    r = session.get(COEITADMIN_URL + hostname, headers=headers, timeout=30)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()
+
+
+def get_ucdnetwork_info(ip, session):
+    headers = {"accept": "application/json", "X-APIf-KEY": os.environ["API_KEY_UCDNETWORK"]}
+    r = session.get(UCDNETWORK_URL, params={"ip": ip}, headers=headers, timeout=30)
+    r.raise_for_status()
+    return r.json()
+
+
+def asset_hostname(asset):
+    # "ou.ad3.ucdavis.edu\JMIE-NORTH" -> "JMIE-NORTH"
+    return asset["NetBIOS"].split("\\")[-1] if asset["NetBIOS"] else ""
+
+
+class HostEnricher:
+    """Prefetches coeitadmin and ucdnetwork records for every asset of a run. """
+
+    def __init__(self, workers=8, session=None, cache=None):
+        self.workers = workers
+        self.session = session
+        # optional SnapshotCache read before any request goes out
+        self.cache = cache
+        # (source, key) -> record, or None for a miss; failures are cached too so a dead host is asked only once
+        self.results = {}
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+    def lookups(self, assets):
+        for asset in assets:
+            hostname = asset_hostname(asset)
+            if hostname:
+                yield ("coeitadmin", hostname), get_ad_computer_info
+            yield ("ucdnetwork", asset["IP"]), get_ucdnetwork_info
+
+    def prefetch(self, assets):
+        jobs = {}
+        stale = {}
+        for key, fetch in self.lookups(assets):
+            if key in self.results or key in jobs:
+                continue
+            if self.cache:
+                cached = self.cache.lookup(*key)
+                if cached is not MISSING:
+                    if cached[1]:
+                        self.results[key] = cached[0]
+                        continue
+                    stale[key] = cached[0]
+            jobs[key] = fetch
+        if not jobs:
+            return
+
+        if self.session is None:
+            self.session = enrichment_session(self.workers)
+        fetched = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(fetch, key[1], self.session): key for key, fetch in jobs.items()}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                try:
+                    self.results[key] = future.result()
+                except Exception as e:
+                    logging.warning("Couldn't get %s info for %s: %s", key[0], key[1], e)
+                    # an expired snapshot beats no information while the API is down
+                    self.results[key] = stale.get(key)
+                    continue
+                fetched.setdefault(key[0], []).append((key[1], self.results[key]))
+
+        if self.cache:
+            for source, items in fetched.items():
+                self.cache.put_many(source, items)
+
+    def refresh_stale(self):
+        # bulk update of every expired coeitadmin/ucdnetwork record in the snapshot cache
+        if self.session is None:
+            self.session = enrichment_session(self.workers)
+        return self.cache.refresh_stale({
+            "coeitadmin": lambda hostname: get_ad_computer_info(hostname, self.session),
+            "ucdnetwork": lambda ip: get_ucdnetwork_info(ip, self.session),
+        }, self.workers)
+
+    def ad_info(self, hostname):
+        return self.results.get(("coeitadmin", hostname))
+
+    def ucdnetwork_info(self, ip):
+        data = self.results.get(("ucdnetwork", ip))
+        return data[0] if data else None
@@ -0,0 +1,177 @@
+#! /usr/bin/python3
+
+import csv
+import enum
+from array import array
+
+
+class Severity(enum.IntEnum):
+    INFO = 0
+    LOW = 1
+    MEDIUM = 2
+    HIGH = 3
+    CRITICAL = 4
+
+    @classmethod
+    def parse(cls, label):
+        try:
+            return cls[label.strip().upper()]
+        except KeyError:
+            raise ValueError("Unknown Tenable severity %r" % label) from None
+
+    @property
+    def label(self):
+        # the spelling used in Tenable exports, e.g. "High"
+        return self.name.title()
+
+
+# largest ID that fits an array("L") entry on every platform
+MAX_PLUGIN_ID = 2 ** 32 - 1
+
+
+class PluginTable:
+    """Interned plugins: every plugin ID and name is stored once per scan.
+
+    IDs are kept as integers; one that isn't written as a plain integer (an empty cell,
+    "007", ...) is kept as the string it came as in raw_ids, so it is written back unchanged.
+    """
+
+    def __init__(self):
+        self.ids = array("L")
+        self.names = []
+        self.index = {}  # int id, or raw string id -> position
+        self.raw_ids = {}  # position -> raw string id
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, plugin_id, name):
+        raw = plugin_id or ""
+        plugin_id = int(raw) if raw.isdecimal() and str(int(raw)) == raw else raw
+        i = self.index.get(plugin_id)
+        if i is None:
+            i = self.index[plugin_id] = len(self.ids)
+            if isinstance(plugin_id, str) or plugin_id > MAX_PLUGIN_ID:
+                self.raw_ids[i] = raw
+                plugin_id = 0
+            self.ids.append(plugin_id)
+            self.names.append(name)
+        return i
+
+    def plugin_id(self, i):
+        # the ID of an interned plugin as it appeared in the export
+        raw = self.raw_ids.get(i)
+        return raw if raw is not None else str(self.ids[i])
+
+
+class FindingStore:
+    """Columnar store of Tenable findings grouped by host.
+
+    Findings are appended as three parallel typed arrays (host, plugin, severity).
+    Severity codes are Severity values, followed by any labels Tenable uses that
+    are not one of them (e.g. "None" or an empty cell), which pass through unchanged.
+    finalize() counting-sorts them by host so every host owns one contiguous
+    [offsets[h], offsets[h + 1]) range, and assets are only expanded into the
+    dict-of-lists shape used by the report code one at a time while iterating.
+    """
+
+    def __init__(self):
+        self.plugins = PluginTable()
+        self.hosts = []  # (ip, netbios, dns, mac) of the first row seen for each host
+        self.host_index = {}
+        self.finding_host = array("L")
+        self.finding_plugin = array("L")
+        self.finding_severity = array("B")
+        self.severity_labels = [s.label for s in Severity]
+        self.severity_index = {}  # unknown label -> code
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.finding_host)
+
+    @classmethod
+    def from_rows(cls, rows):
+        store = cls()
+        for row in rows:
+            store.add(row)
+        return store
+
+    @classmethod
+    def from_csv(cls, filename):
+        with open(filename, "r", newline="") as file:
+            return cls.from_rows(csv.DictReader(file))
+
+    def add(self, row):
+        ip = row["IP Address"]
+        h = self.host_index.get(ip)
+        if h is None:
+            h = self.host_index[ip] = len(self.hosts)
+            self.hosts.append((ip, row["NetBIOS Name"], row["DNS Name"], row["MAC Address"]))
+        self.finding_host.append(h)
+        self.finding_plugin.append(self.plugins.intern(row["Plugin"], row["Plugin Name"]))
+        self.finding_severity.append(self.severity(row["Severity"]))
+        self.offsets = None
+
+    def severity(self, label):
+        label = label or ""
+        try:
+            return Severity.parse(label)
+        except ValueError:
+            pass
+        code = self.severity_index.get(label)
+        if code is None:
+            code = self.severity_index[label] = len(self.severity_labels)
+            self.severity_labels.append(label)
+        return code
+
+    def finalize(self):
+        if self.offsets is not None:
+            return
+        # counting sort by host keeps each host's findings in CSV order
+        offsets = array("L", bytes(array("L").itemsize * (len(self.hosts) + 1)))
+        for h in self.finding_host:
+            offsets[h + 1] += 1
+        for h in range(len(self.hosts)):
+            offsets[h + 1] += offsets[h]
+
+        n = len(self.finding_host)
+        plugins = array("L", bytes(array("L").itemsize * n))
+        severities = array("B", bytes(n))
+        fill = array("L", offsets)
+        for i, h in enumerate(self.finding_host):
+            j = fill[h]
+            plugins[j] = self.finding_plugin[i]
+            severities[j] = self.finding_severity[i]
+            fill[h] = j + 1
+
+        self.finding_plugin = plugins
+        self.finding_severity = severities
+        self.finding_host = array("L")  # implied by offsets from here on
+        self.offsets = offsets
+
+    def rows(self):
+        # (ip, netbios, dns, mac, plugin id, severity label, plugin name) in CSV order, before finalize()
+        if self.offsets is not None:
+            raise RuntimeError("rows() is only available before finalize()")
+        for h, p, s in zip(self.finding_host, self.finding_plugin, self.finding_severity):
+            yield self.hosts[h] + (self.plugins.plugin_id(p), self.severity_labels[s], self.plugins.names[p])
+
+    def asset(self, h):
+        self.finalize()
+        ip, netbios, dns, mac = self.hosts[h]
+        start, end = self.offsets[h], self.offsets[h + 1]
+        plugins = self.finding_plugin[start:end]
+        return {
+            "IP": ip,
+            "NetBIOS": netbios,
+            "DNS": dns,
+            "MAC": mac,
+            "Email Subject": ip + " (" + netbios.split("\\")[-1] + ") - Vulnerability List",
+            "Plugin IDs": [self.plugins.plugin_id(p) for p in plugins],
+            "Severities": [self.severity_labels[s] for s in self.finding_severity[start:end]],
+            "Plugin Names": [self.plugins.names[p] for p in plugins],
+        }
+
+    def __iter__(self):
+        for h in range(len(self.hosts)):
+            yield self.asset(h)
@@ -0,0 +1,22 @@
+#! /usr/bin/python3
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# rate limited or briefly unavailable; urllib3 never replays a POST whatever the status
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def pooled_session(pool_size, status_forcelist=RETRY_STATUSES, pool_connections=1):
+    # keep-alive session for the campus APIs: certificates aren't verified, pool_size
+    # connections are kept per host so every worker thread gets one, and connection
+    # errors and the statuses in status_forcelist are retried with backoff
+    urllib3.disable_warnings()
+    session = requests.Session()
+    session.verify = False
+    retries = Retry(total=3, backoff_factor=0.5, status_forcelist=status_forcelist)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
@@ -1,23 +1,68 @@
 #!/usr/bin/python3
 
-import urllib3.json
-import requests 
+import concurrent.futures
+import json
+import threading
+import urllib3
 import sys
 import getpass
 import argparse
 
+from http_session import pooled_session
+from snapshot_cache import MISSING
+
+WAPI_URL = "https://infoblox.ucdavis.edu/wapi/v2.7.1/"
+FIXEDADDRESS_FIELDS = "comment,ipv4addr,mac,name,network,match_client"
+LEASE_FIELDS = "address,client_hostname,hardware,network"
+# addresses per multi-request in the bulk lookups, two WAPI GETs each
+BATCH_SIZE = 100
+# records per page of a paged WAPI search
+PAGE_SIZE = 1000
+
+
+def infoblox_session(username, password, pool_size=8):
+    # GET/PUT are retried on connection errors and busy responses; POSTs (restarts) are never replayed
+    session = pooled_session(pool_size, status_forcelist=(429, 502, 503, 504))
+    session.auth = (username, password)
+    return session
+
+
 class InfoBlox:
-    def __init__(self, username, password):
+    def __init__(self, username, password, cache=None, pool_size=8):
         urllib3.disable_warnings()
         self.vlans = {}
         self.username = username
         self.password = password
+        # optional SnapshotCache that ip_lookup reads through
+        self.cache = cache
+        # one keep-alive session for every WAPI call; after the first basic auth login
+        # InfoBlox's ibapauth cookie authenticates the following requests
+        self.session = infoblox_session(username, password, pool_size)
+        self.login_lock = threading.Lock()
         self.gather_vlans()
 
+    def close(self):
+        self.session.close()
+
+    def request(self, method, path, **kwargs):
+        response = self.session.request(method, WAPI_URL + path, timeout=60, **kwargs)
+        if response.status_code == 401 and self.session.auth is None:
+            # ibapauth cookie expired, log in again with basic auth
+            with self.login_lock:
+                self.session.cookies.clear()
+                self.session.auth = (self.username, self.password)
+            response = self.session.request(method, WAPI_URL + path, timeout=60, **kwargs)
+        if self.session.auth is not None and "ibapauth" in self.session.cookies:
+            with self.login_lock:
+                self.session.auth = None
+        return response
+
+    def get(self, path, params=None):
+        return self.request("GET", path, params=params)
+
     def restart_services(self):
         try:
-            updateurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/member/b25lLnZpcnR1YWxfbm9kZSQw:ib-ns.ucdavis.edu"
-            response = requests.post(updateurl, data={'_function': 'restartservices','restart_option':'RESTART_IF_NEEDED','service_option':'DHCP'}, verify=False, auth=(self.username,self.password))
+            response = self.request("POST", "member/b25lLnZpcnR1YWxfbm9kZSQw:ib-ns.ucdavis.edu", data={'_function': 'restartservices','restart_option':'RESTART_IF_NEEDED','service_option':'DHCP'})
             if response.status_code == 200:
                 print("Restarted InfoBlox")
             else:
@@ -28,110 +73,196 @@ class InfoBlox:
             print(e)
             print(response.content)
 
+    def paged(self, obj, params, page_size=PAGE_SIZE):
+        # yields the records of a WAPI search one page at a time, so a search is never
+        # cut off at the server's result cap and only one page is held in memory
+        params = dict(params, _paging=1, _max_results=page_size, _return_as_object=1)
+        while True:
+            response = self.get(obj, params)
+            response.raise_for_status()
+            page = response.json()
+            yield from page["result"]
+            if not page.get("next_page_id"):
+                return
+            params = {'_page_id': page["next_page_id"]}
+
+    def iter_networks(self):
+        return self.paged("network", {'_return_fields': 'comment,network'})
+
     def gather_vlans(self):
-        searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/network?_return_type=json-pretty&_return_fields=comment,network"
-        response = requests.get(searchurl, verify=False, auth=(self.username,self.password))
-        networks = {}
         try:
-            data = json.loads(response.content)
-            for x in data:
-                networks[x["network"]] = x["comment"]
-            self.vlans = networks
-    
+            self.vlans = {x["network"]: x.get("comment", "") for x in self.iter_networks()}
         except Exception as e:
             print("Error parsing json in gather_vlans()")
             print(e)
-            print(response.content)
     
+    def annotate(self, data):
+        # adds the VLAN from the cached network table and a readable type to a fixedaddress/lease record
+        data["vlan"] = self.vlans.get(data["network"], "")
+        if (data["_ref"].split('/', 1)[0]) == "fixedaddress":
+            data["type"] = "Fixed Address"
+        elif (data["_ref"].split('/', 1)[0]) == "lease":
+            data["type"] = "Active lease"
+        # move the _ref key it comes with to the end, don't fail if doesn't exist
+        a = data.pop('_ref', None)
+        data['_ref'] = a
+        return data
+
+    def multi(self, queries):
+        # several WAPI GETs in one round trip through the multi-request endpoint;
+        # queries are (object, search fields, return fields), results come back in the same order
+        body = [{"method": "GET", "object": obj, "data": data, "args": {"_return_fields": fields}}
+                for obj, data, fields in queries]
+        response = self.request("POST", "request", json=body)
+        response.raise_for_status()
+        return response.json()
+
     def obj_lookup(self, obj):
         action = obj.split('/', 1)[0]
         ip = (obj.split(':', 1)[1]).split('/', 1)[0]
-        searchurl = ""
         if action == "fixedaddress":
-            searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/fixedaddress?ipv4addr="+ip+"&_return_type=json-pretty&_return_fields=comment,ipv4addr,mac,name,network,match_client"
+            response = self.get("fixedaddress", {'ipv4addr': ip, '_return_fields': FIXEDADDRESS_FIELDS})
         elif action == "lease":
-            searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/lease?address="+ip+"&_return_type=json-pretty&_return_fields=address,client_hostname,hardware,network"
+            response = self.get("lease", {'address': ip, '_return_fields': LEASE_FIELDS})
         else:
             print("object not found")
-    
-        response = requests.get(searchurl, verify=False, auth=(self.username,self.password))
+            return
         try:
-            data = json.loads(response.content)[0]
-            # empty dicts evaluate to false
-            if not self.vlans:
-                self.gather_vlans()
-
-            data["vlan"] = self.vlans[data["network"]]
-            if (data["_ref"].split('/', 1)[0]) == "fixedaddress":
-                data["type"] = "Fixed Address"
-            elif (data["_ref"].split('/', 1)[0]) == "lease":
-                data["type"] = "Active lease"
-            # delete _ref key that it comes with, don't fail if doesn't exist
-            a = data.pop('_ref', None)
-            data['_ref'] = a
-            return data
+            return self.annotate(json.loads(response.content)[0])
         except Exception as e:
             print("Error parsing json in obj_lookup() with lease")
             print(e)
             print(response.content)
 
-    def find_all(self, network, match_type):
-        searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/fixedaddress?network="+network+"&_return_fields=comment,ipv4addr,mac,name,network,match_client&_return_type=json-pretty"
+    def iter_find_all(self, network, match_type):
+        params = {'network': network, '_return_fields': FIXEDADDRESS_FIELDS}
 
         if match_type == "reserved":
-            searchurl += "&match_client=RESERVED"
+            params['match_client'] = "RESERVED"
         elif match_type == "MAC_ADDRESS":
-            searchurl += "&match_client=MAC_ADDRESS"
+            params['match_client'] = "MAC_ADDRESS"
         else:
             pass
 
-        response = requests.get(searchurl, verify=False, auth=(self.username, self.password))
+        return self.paged("fixedaddress", params)
+
+    def find_all(self, network, match_type):
         try:
-            raw_data=json.loads(response.content)
+            raw_data = list(self.iter_find_all(network, match_type))
             if len(raw_data) == 0:
                 print('Nothing returned for vlan: ' + network)
-                return raw_data
-            else:
-                return raw_data
+            return raw_data
         except Exception as e:
-            print("Error parsing json in ip_lookup():")
+            print("Error parsing json in find_all():")
             print(e)
-            print(raw_data)
      
     def ip_lookup(self, ip):
-        searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/ipv4address?ip_address="+ip+'&_return_type=json-pretty&_return_fields=lease_state,objects,status,ip_address,network'
-        
-        response = requests.get(searchurl, verify=False, auth=(self.username, self.password))
+        # "no record" (None) is cached like any other answer; when InfoBlox fails or is
+        # unreachable the expired snapshot is used instead, if there is one
         try:
-            raw_data=json.loads(response.content)
-            if len(raw_data) == 0:
-                print ('Nothing returned')
-            else:
-                objects = raw_data[0]["objects"]
-                return [self.obj_lookup(x) for x in objects]
+            if self.cache:
+                return self.cache.get("infoblox", ip, self.fetch_ip)
+            return self.fetch_ip(ip)
         except Exception as e:
             print("Error parsing json in ip_lookup():")
             print(e)
-            print(raw_data)
+
+    @staticmethod
+    def ip_queries(ip):
+        return [
+            ("fixedaddress", {'ipv4addr': ip}, FIXEDADDRESS_FIELDS),
+            ("lease", {'address': ip}, LEASE_FIELDS),
+        ]
+
+    @staticmethod
+    def mac_queries(mac):
+        return [
+            ("fixedaddress", {'mac': mac}, FIXEDADDRESS_FIELDS),
+            ("lease", {'hardware': mac}, LEASE_FIELDS),
+        ]
+
+    def ip_records(self, fixed, leases):
+        # None when InfoBlox has neither a fixed address nor a lease, like ip_lookup always returned
+        return [self.annotate(x) for x in fixed[:1] + leases[:1]] or None
+
+    def mac_records(self, fixed, leases):
+        return [self.annotate(x) for x in fixed + leases] or None
+
+    def fetch_ip(self, ip):
+        # the fixed address and the lease of an IP are fetched together instead of
+        # listing the IP's objects and looking each one up separately; None means InfoBlox
+        # has no record, a failed request raises
+        records = self.ip_records(*self.multi(self.ip_queries(ip)))
+        if records is None:
+            print ('Nothing returned')
+        return records
     
     def mac_lookup(self, mac):
-        searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/search?"+"mac_address="+mac+'&_return_type=json-pretty&_return_fields=address,fqdn,mac_address,objtype,network'
-        response = requests.get(searchurl, verify=False, auth=(self.username, self.password))
         try:
-            raw_data=json.loads(response.content)
-            if len(raw_data) == 0:
+            records = self.mac_records(*self.multi(self.mac_queries(mac)))
+            if records is None:
                 print ('Nothing returned')
             else:
-                objects = [ x["_ref"] for x in raw_data ] 
-                return [self.obj_lookup(x) for x in objects]
+                return records
         except Exception as e:
             print("Error parsing json in mac_lookup():")
             print(e)
-            print(raw_data)
 
-    def reserve_ip(self, ip):
-        searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/fixedaddress?ipv4addr=" + ip + "&_return_type=json-pretty&_return_fields=comment,ipv4addr,mac,name,network,match_client"
-        response = requests.get(searchurl, verify=False, auth=(self.username, self.password))
+    def bulk(self, keys, queries, records, batch_size, workers):
+        # packs the queries of batch_size keys into each multi-request and sends the batches concurrently;
+        # keys of a batch that failed are left out of the returned dict
+        keys = list(dict.fromkeys(keys))
+        batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+
+        def run(batch):
+            answers = self.multi([query for key in batch for query in queries(key)])
+            return {key: records(*answers[2 * n:2 * n + 2]) for n, key in enumerate(batch)}
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run, batch): batch for batch in batches}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.update(future.result())
+                except Exception as e:
+                    batch = futures[future]
+                    print("Error looking up %s..%s (%s addresses) in InfoBlox:" % (batch[0], batch[-1], len(batch)))
+                    print(e)
+        return results
+
+    def fetch_ips(self, ips, batch_size=BATCH_SIZE, workers=4):
+        # {ip: fetch_ip(ip)}; IPs of a failed batch are missing from the result
+        return self.bulk(ips, self.ip_queries, self.ip_records, batch_size, workers)
+
+    def bulk_ip_lookup(self, ips, batch_size=BATCH_SIZE, workers=4):
+        # {ip: ip_lookup(ip)} for a whole scan in len(ips) / batch_size requests
+        results = {}
+        stale = {}
+        missing = []
+        for ip in dict.fromkeys(ips):
+            cached = self.cache.lookup("infoblox", ip) if self.cache else MISSING
+            if cached is not MISSING:
+                if cached[1]:
+                    results[ip] = cached[0]
+                    continue
+                stale[ip] = cached[0]
+            missing.append(ip)
+
+        fetched = self.fetch_ips(missing, batch_size, workers)
+        if self.cache:
+            self.cache.put_many("infoblox", fetched.items())
+        for ip in missing:
+            # an IP missing from fetched was in a failed batch, fall back to its expired snapshot
+            results[ip] = fetched[ip] if ip in fetched else stale.get(ip)
+        return results
+
+    def bulk_mac_lookup(self, macs, batch_size=BATCH_SIZE, workers=4):
+        # {mac: mac_lookup(mac)}; MACs of a failed batch are missing from the result
+        return self.bulk(macs, self.mac_queries, self.mac_records, batch_size, workers)
+
+    def reserve_ip(self, ip, restart=True):
+        # restart=False leaves the DHCP restart to the caller, see batch() for many addresses
+        response = self.get("fixedaddress", {'ipv4addr': ip, '_return_fields': FIXEDADDRESS_FIELDS})
 
         try: 
             raw_data=json.loads(response.content)
@@ -139,31 +270,29 @@ class InfoBlox:
                 print('Nothing returned')
                 print('needs to create reserved ip')
             else:
-                objects = [ x["_ref"] for x in raw_data ]
-                a = [self.obj_lookup(x) for x in objects]
-                if a[0]['match_client'] == 'MAC_ADDRESS':
-                    obj_ref = a[0]['_ref']
-                    updateurl = 'https://infoblox.ucdavis.edu/wapi/v2.7.1/' + obj_ref
-                    response = requests.put(updateurl, data={'match_client':'RESERVED', 'name':'', 'comment':''},verify=False, auth=(self.username, self.password))
+                # the search above already returned every field, no need to look each ref up again
+                a = [self.annotate(x) for x in raw_data]
+                change, status = reservation(a[0])
+                if change:
+                    response = self.request("PUT", a[0]['_ref'], data=change)
                     if response.status_code == 200:
                         print("Reserved ip")
-                        self.restart_services()
+                        if restart:
+                            self.restart_services()
                     else:
                         return [response.status_code, response.text]
-                elif a[0]['match_client'] == 'RESERVED':
-                    print("ip already reserved")
                 else:
-                    print("ip not in a registered state to reserve")
-                    print(a)
+                    print(status)
+                    if status != "ip already reserved":
+                        print(a)
 
         except Exception as e:
             print("Error parsing json in reserve_ip():")
             print(e)
             print(raw_data)
 
-    def register_ip(self, ip, mac, name, comment):
-        searchurl = "https://infoblox.ucdavis.edu/wapi/v2.7.1/fixedaddress?ipv4addr=" + ip + "&_return_type=json-pretty&_return_fields=comment,ipv4addr,mac,name,network,match_client"
-        response = requests.get(searchurl, verify=False, auth=(self.username, self.password))
+    def register_ip(self, ip, mac, name, comment, restart=True):
+        response = self.get("fixedaddress", {'ipv4addr': ip, '_return_fields': FIXEDADDRESS_FIELDS})
 
         try: 
             raw_data=json.loads(response.content)
@@ -171,24 +300,123 @@ class InfoBlox:
                 print('Nothing returned')
                 print('needs to create reserved ip')
             else:
-                objects = [ x["_ref"] for x in raw_data ]
-                a = [self.obj_lookup(x) for x in objects]
-                if a[0]['match_client'] == 'RESERVED':
-                    obj_ref = a[0]['_ref']
-                    updateurl = 'https://infoblox.ucdavis.edu/wapi/v2.7.1/' + obj_ref
-                    response = requests.put(updateurl, data={'match_client':'MAC_ADDRESS','mac':mac,'comment':comment,'name':name},verify=False,auth=(self.username,self.password))
+                # the search above already returned every field, no need to look each ref up again
+                a = [self.annotate(x) for x in raw_data]
+                change, status = registration(a[0], mac, name, comment)
+                if change:
+                    response = self.request("PUT", a[0]['_ref'], data=change)
                     if response.status_code == 200:
                         print("Registered ip")
-                        self.restart_services()
+                        if restart:
+                            self.restart_services()
                     else:
                         return [response.status_code, response.text]
-                elif a[0]['match_client'] == 'MAC_ADDRESS':
-                    print("ip already registered")
-                    print(a[0])
                 else:
-                    print("IP not in a reserved state to register")
-                    print(a)
+                    print(status)
+                    print(a[0] if status == "ip already registered" else a)
         except Exception as e:
             print("Error parsing json in regester_ip():")
             print(e)
             print(raw_data)
+
+    def batch(self, workers=4):
+        return IPAMBatch(self, workers)
+
+
+def reservation(record):
+    # (PUT data, status) to turn a registered fixed address into a reservation
+    if record['match_client'] == 'MAC_ADDRESS':
+        return {'match_client':'RESERVED', 'name':'', 'comment':''}, "reserved"
+    elif record['match_client'] == 'RESERVED':
+        return None, "ip already reserved"
+    return None, "ip not in a registered state to reserve"
+
+
+def registration(record, mac, name, comment):
+    # (PUT data, status) to register a reserved fixed address to a MAC
+    if record['match_client'] == 'RESERVED':
+        return {'match_client':'MAC_ADDRESS','mac':mac,'comment':comment,'name':name}, "registered"
+    elif record['match_client'] == 'MAC_ADDRESS':
+        return None, "ip already registered"
+    return None, "IP not in a reserved state to register"
+
+
+class IPAMBatch:
+    """Queues reservations and registrations and applies them together.
+
+    with ib.batch() as batch:
+        batch.reserve("169.237.4.10")
+        batch.register("169.237.4.11", "00:11:22:33:44:55", "name", "comment")
+
+    On exit every queued address is looked up through multi-requests, the PUTs are sent
+    concurrently and DHCP is restarted once if anything changed. batch.results then maps
+    each IP to its status, or to [status code, text] for a failed PUT.
+    """
+
+    def __init__(self, infoblox, workers=4):
+        self.infoblox = infoblox
+        self.workers = workers
+        self.queued = {}  # ip -> (planner, args); a later entry for the same ip wins
+        self.results = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.apply()
+
+    def reserve(self, ip):
+        self.queued[ip] = (reservation, ())
+
+    def register(self, ip, mac, name, comment):
+        self.queued[ip] = (registration, (mac, name, comment))
+
+    def apply(self):
+        ib = self.infoblox
+        ips = list(self.queued)
+        records = {}
+        for i in range(0, len(ips), BATCH_SIZE):
+            chunk = ips[i:i + BATCH_SIZE]
+            try:
+                answers = ib.multi([("fixedaddress", {'ipv4addr': ip}, FIXEDADDRESS_FIELDS) for ip in chunk])
+            except Exception as e:
+                print("Error looking up %s..%s in InfoBlox:" % (chunk[0], chunk[-1]))
+                print(e)
+                self.results.update((ip, "lookup failed") for ip in chunk)
+                continue
+            records.update((ip, answer[0]) for ip, answer in zip(chunk, answers) if answer)
+
+        changes = {}
+        for ip in ips:
+            if ip in self.results:
+                continue
+            if ip not in records:
+                self.results[ip] = "needs to create reserved ip"
+                continue
+            planner, args = self.queued[ip]
+            change, status = planner(records[ip], *args)
+            if change:
+                changes[ip] = (records[ip]['_ref'], change, status)
+            else:
+                self.results[ip] = status
+
+        def put(ip):
+            ref, change, status = changes[ip]
+            response = ib.request("PUT", ref, data=change)
+            return status if response.status_code == 200 else [response.status_code, response.text]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(put, ip): ip for ip in changes}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    self.results[futures[future]] = future.result()
+                except Exception as e:
+                    self.results[futures[future]] = [None, str(e)]
+
+        changed = [ip for ip in changes if self.results[ip] == changes[ip][2]]
+        print("%s of %s addresses changed" % (len(changed), len(ips)))
+        if changed:
+            ib.restart_services()
+        self.queued = {}
+        return self.results
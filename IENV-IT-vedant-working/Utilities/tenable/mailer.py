@@ -0,0 +1,115 @@
+#! /usr/bin/python3
+
+import logging
+import queue
+import smtplib
+import ssl
+import threading
+
+
+class Mailer:
+    """Pool of authenticated SMTP connections reused across many messages. """
+
+    # reconnect after this many messages, Office365 and Gmail both drop long lived sessions
+    MAX_MESSAGES_PER_CONNECTION = 100
+
+    def __init__(self, smtp_server, port, username, password, pool_size=2, timeout=60):
+        self.smtp_server = smtp_server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.context = ssl.create_default_context()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        server = smtplib.SMTP(self.smtp_server, self.port, timeout=self.timeout)
+        try:
+            server.starttls(context=self.context)
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        server.messages_sent = 0
+        return server
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            new_connection = self._open < self.pool_size
+            if new_connection:
+                self._open += 1
+        if not new_connection:
+            return self._idle.get()
+
+        try:
+            return self.connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+            raise
+
+    def release(self, server):
+        if server.messages_sent >= self.MAX_MESSAGES_PER_CONNECTION:
+            self.discard(server)
+        else:
+            self._idle.put(server)
+
+    def discard(self, server):
+        with self._lock:
+            self._open -= 1
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def send(self, sender, receivers, message):
+        # message is either an email.message.Message or an already formatted string
+        server = self.acquire()
+        try:
+            self._send(server, sender, receivers, message)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPHeloError, ConnectionError) as e:
+            logging.info("SMTP connection lost (%s), reconnecting", e)
+            self.discard(server)
+            server = self.acquire()
+            try:
+                self._send(server, sender, receivers, message)
+            except Exception:
+                self.discard(server)
+                raise
+        except smtplib.SMTPRecipientsRefused:
+            # the session is still usable, only this message failed
+            self.release(server)
+            raise
+        except Exception:
+            self.discard(server)
+            raise
+        self.release(server)
+
+    def _send(self, server, sender, receivers, message):
+        if isinstance(message, str):
+            server.sendmail(sender, receivers, message)
+        else:
+            server.send_message(message, sender, receivers)
+        server.messages_sent += 1
+
+    def close(self):
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(server)
@@ -1,15 +1,23 @@
 #! /usr/bin/python3
 
-import ipaddress
+import concurrent.futures
 import csv
+import functools
+import json
+import os
+import re
+import threading
+import time
 
 import logging
-from bs4 import BeautifulSoup
 import urllib3
-from urllib.parse import urlencode
 from selenium.common.exceptions import TimeoutException
 
+import netadmin_parser
+from cookie_jar import EncryptedCookieJar
 from duo import MyNetworkDuoLogin
+from http_session import pooled_session
+from vlan_index import VlanIndex
 
 
 class Error(Exception):
@@ -30,163 +38,276 @@ class MissingDataError(Error):
     pass
 
 
+BUILDING_FILES = ("Buildings.csv", "CustomBuildings.csv")
+# seconds a scraped VLAN MAC table is reused before it is fetched again
+MAC_TABLE_TTL = 15 * 60
+# concurrent page requests when sweeping many VLANs
+SWEEP_WORKERS = 8
+# encrypted MyNetwork session cookies, reused until check_session fails
+COOKIE_JAR = "./mynetwork_cookies.enc"
+# VLAN SUMMARY page cached on disk, and for how many seconds
+VLAN_CACHE = "./mynetwork_vlans.json"
+VLAN_TTL = 24 * 3600
+
+
+def normalize_mac(mac):
+    # "00:1A:2B:3C:4D:5E", "001a.2b3c.4d5e" and "00-1a-2b-3c-4d-5e" -> "001a2b3c4d5e"
+    return re.sub(r"[^0-9a-f]", "", mac.lower())
+
+
+@functools.lru_cache(maxsize=None)
+def load_building_names(files=BUILDING_FILES):
+    """FDX code -> building name from the campus building lists, read once per process. """
+    buildings = {}
+    for filename in files:
+        with open(filename, newline="") as csv_file:
+            csv_reader = csv.reader(csv_file, delimiter=",")
+            header = next(csv_reader)
+            code, name = header.index("FDX Code"), header.index("Building Name")
+            for row in csv_reader:
+                if len(row) > max(code, name):
+                    # the first list to name a code wins, as with the old linear search
+                    buildings.setdefault(row[code], row[name])
+    return buildings
+
+
 class MyNetwork:
-    def __init__(self, username, password, environment="production"):
+    def __init__(self, username, password, environment="production", cookie_jar=COOKIE_JAR, headless=True,
+                 vlan_cache=VLAN_CACHE, vlan_ttl=VLAN_TTL):
         urllib3.disable_warnings()
         self.base_url = "https://mynetwork.noc.ucdavis.edu/cgi-bin/netadmin.pl"
         self.username = username
         self.password = password
-        self.selenium = None
         self.environment = environment
-        self.authenticate()
-        self.vlans = self.gather_vlans()
-
-    def refresh(self):
-        if not self.check_session():
-            logging.info("check_session failed, re-authentication with MyNetwork")
-            try:
-                self.selenium.login(self.username, self.password)
-            except Exception:
-                raise AuthenticationError("Relogin failed")
+        self.headless = headless
+        # the browser only logs in; pages are fetched over plain HTTP with the exported cookies,
+        # which are kept encrypted on disk so later runs skip the Duo login entirely
+        self.cookie_jar = EncryptedCookieJar(cookie_jar, password) if cookie_jar else None
+        self.session = None
+        # authentication waits for the first page actually needed
+        self.authenticated = False
+        self.login_lock = threading.Lock()
+        # vlan -> (time fetched, {normalized mac: get_active_macs row})
+        self.mac_tables = {}
+        self.vlan_cache = vlan_cache
+        self.vlan_ttl = vlan_ttl
+        self.vlans = self.load_vlans()
+        self.vlan_index = VlanIndex({vlan["subnet"]: vlan for vlan in self.vlans if vlan["subnet"]})
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+    def ensure_session(self):
+        with self.login_lock:
+            if not self.authenticated:
+                self.authenticate()
+                self.authenticated = True
+
+    def refresh(self, expired=None):
+        # expired is the session a page was just refused on; when several threads notice at
+        # once, only the first one logs in again and the others reuse its session
+        self.ensure_session()
+        with self.login_lock:
+            if expired is not None and self.session is not expired:
+                return
+            if not self.check_session():
+                logging.info("check_session failed, re-authentication with MyNetwork")
+                try:
+                    self.login()
+                except Exception:
+                    raise AuthenticationError("Relogin failed")
 
     def check_session(self):
-        resp = self.selenium.get(self.base_url)
-        soup = BeautifulSoup(resp, "html.parser")
-        confirmation = soup.title.text
+        # only reads the start of the VLAN SUMMARY page, up to its title, instead of the whole page
+        if self.session is None:
+            return False
+        head = b""
+        try:
+            with self.session.get(self.base_url, stream=True, timeout=30) as resp:
+                for chunk in resp.iter_content(4096):
+                    head += chunk
+                    if b"</title>" in head.lower() or len(head) > 65536:
+                        break
+        except Exception as e:
+            logging.debug("check_session request failed: %s", e)
+            return False
+        match = re.search(rb"<title>(.*?)</title>", head, re.IGNORECASE | re.DOTALL)
+        confirmation = match.group(1).decode(errors="replace") if match else ""
 
         if confirmation == " VLAN SUMMARY ":
             return True
 
         logging.debug("ALERT")
-        logging.debug(soup)
-        logging.debug(soup.title.text)
+        logging.debug(head)
+        logging.debug(confirmation)
         return False
 
     def authenticate(self):
+        saved = self.cookie_jar.load() if self.cookie_jar else None
+        if saved:
+            self.use_cookies(saved["cookies"], saved["user_agent"])
+            if self.check_session():
+                return
+            logging.info("Saved MyNetwork session expired, logging in again")
+        self.login()
+        if not self.check_session():
+            raise AuthenticationError("Authentication failed")
+
+    def login(self):
         try:
-            self.selenium = MyNetworkDuoLogin(
-                self.username, self.password, self.environment
+            browser = MyNetworkDuoLogin(
+                self.username, self.password, self.environment, self.headless
             )
         except TimeoutException:
             raise AuthenticationError("Duo prompt not accepted")
-        if not self.check_session():
-            raise AuthenticationError("Authentication failed")
+        try:
+            cookies = browser.export_cookies()
+            user_agent = browser.user_agent()
+        finally:
+            browser.close()
+
+        self.use_cookies(cookies, user_agent)
+        if self.cookie_jar:
+            self.cookie_jar.save({"cookies": cookies, "user_agent": user_agent})
+
+    def use_cookies(self, cookies, user_agent, pool_size=SWEEP_WORKERS):
+        # plain HTTP client carrying the cookies of the Duo-authenticated browser session
+        if self.session:
+            self.session.close()
+        session = pooled_session(pool_size)
+        session.headers["User-Agent"] = user_agent
+        for cookie in cookies:
+            session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+        self.session = session
+
+    def get(self, params=None):
+        # raw bytes of a netadmin.pl page, which netadmin_parser reads without decoding them first.
+        # netadmin.pl answers with its login page once the session cookies expire; log in
+        # again once and retry rather than hand the login page to a parser
+        self.ensure_session()
+        for attempt in range(2):
+            session = self.session
+            resp = session.get(self.base_url, params=params, timeout=120)
+            resp.raise_for_status()
+            if b'name="password"' not in resp.content:
+                return resp.content
+            if attempt == 0:
+                self.refresh(expired=session)
+        raise AuthenticationError("netadmin.pl returned the login page, session cookies expired")
 
     def gather_vlans(self):
-        resp = self.selenium.get(self.base_url)
-        soup = BeautifulSoup(resp, "html.parser")
-        title = soup.title.text
+        title, vlans = netadmin_parser.parse_vlan_summary(self.get())
         if title != " VLAN SUMMARY ":
             raise AuthenticationError(
                 "gather_vlans() page title not 'VLAN SUMMARY', likely to be an authentication issue"
             )
 
-        raw_vlans_info = soup.find_all("pre")
-        # format of start, end, gateway, mask
-        vlans = []
-        for vlan_info in raw_vlans_info:
-            # in format of first, last, gateway, netmask
-            subnet_info = (
-                vlan_info.contents[0].split("Subnet Mask\n")[1].split("\n")[0].split()
-            )
-            vlan_arr = vlan_info.contents[0].split("Tag\n")[1].split("____")[0].split()
+        return [vlan._asdict() for vlan in vlans]
 
-            subnet = ""
+    def load_vlans(self, force=False):
+        # the VLAN summary rarely changes, so it is read from vlan_cache while younger than vlan_ttl
+        if self.vlan_cache and not force:
             try:
-                subnet = ipaddress.IPv4Network((subnet_info[0], subnet_info[3]), False)
-            except Exception:
-                subnet = ""
-
-
-            vlan_tag = vlan_arr[1] if len(vlan_arr) == 2 else ''
-            vlan = {"name": vlan_arr[0], "tag": vlan_tag, "subnet": str(subnet)}
-            vlans.append(vlan)
-
+                with open(self.vlan_cache) as file:
+                    cached = json.load(file)
+                if time.time() - cached["fetched"] < self.vlan_ttl:
+                    return cached["vlans"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        vlans = self.gather_vlans()
+        if self.vlan_cache:
+            tmp = self.vlan_cache + ".tmp"
+            with open(tmp, "w") as file:
+                json.dump({"fetched": time.time(), "vlans": vlans}, file)
+            os.replace(tmp, self.vlan_cache)
         return vlans
 
+    def vlan_for_ip(self, ip):
+        # {"name", "tag", "subnet"} of the VLAN whose subnet holds ip, or None
+        return self.vlan_index.lookup(ip)
+
     def get_standard_building_names(self):
-        filename = "Buildings.csv"
-        custom_buildings = "CustomBuildings.csv"
-        buildings = []
-        with open(filename) as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=",")
-            for row in csv_reader:
-                buildings.append(
-                    {"FDX Code": row["FDX Code"], "Building Name": row["Building Name"]}
-                )
-        with open(custom_buildings) as csv_file:
-            csv_reader = csv.DictReader(csv_file, delimiter=",")
-            for row in csv_reader:
-                buildings.append(
-                    {"FDX Code": row["FDX Code"], "Building Name": row["Building Name"]}
-                )
-        return buildings
+        # FDX code -> building name, shared by every MyNetwork instance
+        return load_building_names()
 
     # vlan in the form of ENG-CIVL&ENV-1
     def get_active_macs(self, vlan):
         # https://mynetwork.noc.ucdavis.edu/cgi-bin/netadmin.pl?maclist=ENG-CIVL%26ENV-1&period=Month
-        buildings = self.get_standard_building_names()
-        macs = []
         payload = {"maclist": vlan, "period": "Month"}
-        qstr = urlencode(payload)
-        resp = self.selenium.get(self.base_url + "?" + qstr)
-        soup = BeautifulSoup(resp, "lxml")
-        rows = soup.find_all("tr", {"valign": "center"})
-        for row in rows:
-            data = {}
-            cells = row.find_all("td")
-            building = cells[1].text.strip()
-            proper_building_name = next(
-                (
-                    item["Building Name"]
-                    for item in buildings
-                    if item["FDX Code"] == building
-                ),
-                building,
-            )
-            data["nam"] = cells[0].text.strip()
-            data["building"] = proper_building_name
-            data["room"] = cells[2].text.strip()
-            data["switch"] = cells[3].text.strip()
-            data["port"] = cells[4].text.strip()
-            data["mac"] = cells[5].text.strip()
-            data["last_seen"] = cells[6].text.strip()
-            macs.append(data)
+        resp = self.get(payload)
+        return self.parse_active_macs(resp)
 
-        return macs
+    def parse_active_macs(self, html):
+        buildings = self.get_standard_building_names()
+        return [
+            row._replace(building=buildings.get(row.building, row.building))._asdict()
+            for row in netadmin_parser.parse_active_macs(html)
+        ]
+
+    def mac_table(self, vlan, max_age=MAC_TABLE_TTL):
+        # the active MACs of a VLAN indexed by normalized MAC, scraped at most once per max_age
+        fetched, index = self.mac_tables.get(vlan, (0, None))
+        if index is None or time.monotonic() - fetched > max_age:
+            index = {normalize_mac(item["mac"]): item for item in self.get_active_macs(vlan)}
+            self.mac_tables[vlan] = (time.monotonic(), index)
+        return index
+
+    def locate_mac(self, vlan, mac, max_age=MAC_TABLE_TTL):
+        # get_active_macs row (building, room, switch, port, ...) of a MAC, or None if it wasn't seen;
+        # mac may list several addresses, as Tenable's MAC Address column does
+        index = self.mac_table(vlan, max_age)
+        for address in re.split(r"[\s,]+", mac):
+            key = normalize_mac(address)
+            if key and key in index:
+                return index[key]
+        return None
 
     # vlan in the form of ENG-CIVL&ENV-1
     def get_nams(self, vlan):
         # https://mynetwork.noc.ucdavis.edu/cgi-bin/netadmin.pl?span=ENG-CIVL%26ENV-1
+        payload = {"span": vlan}
+        resp = self.get(payload)
+        return self.parse_nams(resp)
 
+    def parse_nams(self, html):
         buildings = self.get_standard_building_names()
-        nams = []
-        payload = {"span": vlan}
-        qstr = urlencode(payload)
-        resp = self.selenium.get(self.base_url + "?" + qstr)
-        soup = BeautifulSoup(resp, "lxml")
-        rows = soup.find_all("tr", {"valign": "center"})
-        for row in rows:
-            data = {}
-            cells = row.find_all("td")
-
-            building = cells[1].text.strip()
-            proper_building_name = next(
-                (
-                    item["Building Name"]
-                    for item in buildings
-                    if item["FDX Code"] == building
-                ),
-                building,
-            )
-            data["nam"] = cells[0].text.strip()
-            data["building"] = proper_building_name
-            data["room"] = cells[2].text.strip()
-            data["switch"] = cells[3].text.strip()
-            data["port"] = cells[4].text.strip()
-            data["port_state"] = cells[5].text.strip()
-            data["configured_speed"] = cells[6].text.strip()
-            data["actual_speed"] = cells[7].text.strip()
-            nams.append(data)
-
-        return nams
+        return [
+            row._replace(building=buildings.get(row.building, row.building))._asdict()
+            for row in netadmin_parser.parse_nams(html)
+        ]
+
+    def fetch_pages(self, queries, parse, workers=SWEEP_WORKERS):
+        # queries maps a key to the netadmin.pl query of its page; pages are fetched on the shared session with at most
+        # workers requests in flight and parsed as they arrive. Returns {key: parsed rows},
+        # keys whose page couldn't be fetched are logged and left out
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.get, params): key for key, params in queries.items()}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                try:
+                    results[key] = parse(future.result())
+                except AuthenticationError:
+                    raise
+                except Exception as e:
+                    logging.warning("Couldn't fetch %s from MyNetwork: %s", key, e)
+        return results
+
+    def sweep_active_macs(self, vlans=None, workers=SWEEP_WORKERS):
+        # {vlan: get_active_macs(vlan)} for the given VLANs, every VLAN by default;
+        # also fills the MAC table cache used by locate_mac
+        self.refresh()
+        vlans = vlans if vlans is not None else [vlan["name"] for vlan in self.vlans]
+        tables = self.fetch_pages({vlan: {"maclist": vlan, "period": "Month"} for vlan in vlans}, self.parse_active_macs, workers)
+        now = time.monotonic()
+        for vlan, macs in tables.items():
+            self.mac_tables[vlan] = (now, {normalize_mac(item["mac"]): item for item in macs})
+        return tables
+
+    def sweep_nams(self, vlans=None, workers=SWEEP_WORKERS):
+        # {vlan: get_nams(vlan)} for the given VLANs, every VLAN by default
+        self.refresh()
+        vlans = vlans if vlans is not None else [vlan["name"] for vlan in self.vlans]
+        return self.fetch_pages({vlan: {"span": vlan} for vlan in vlans}, self.parse_nams, workers)
@@ -0,0 +1,103 @@
+#! /usr/bin/python3
+
+import io
+import ipaddress
+from typing import NamedTuple
+
+from lxml import etree
+
+
+class ActiveMac(NamedTuple):
+    nam: str
+    building: str
+    room: str
+    switch: str
+    port: str
+    mac: str
+    last_seen: str
+
+
+class NamPort(NamedTuple):
+    nam: str
+    building: str
+    room: str
+    switch: str
+    port: str
+    port_state: str
+    configured_speed: str
+    actual_speed: str
+
+
+class Vlan(NamedTuple):
+    name: str
+    tag: str
+    subnet: str
+
+
+def iter_elements(page, tags):
+    # streams the elements of an HTML page (bytes as fetched, or str) as they are closed,
+    # dropping each one (and everything before it) once it has been handled so the tree never grows
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+    for _, elem in etree.iterparse(io.BytesIO(page), events=("end",), tag=tags, html=True, recover=True):
+        yield elem
+        elem.clear(keep_tail=True)
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+def cell_text(td):
+    # most cells are plain text, only walk the subtree when there is markup inside
+    if len(td) == 0:
+        return (td.text or "").strip()
+    return "".join(td.itertext()).strip()
+
+
+def iter_table_rows(page, width):
+    # cell texts of every <tr valign="center"> data row with at least width cells
+    for tr in iter_elements(page, "tr"):
+        if tr.get("valign") != "center":
+            continue
+        cells = [cell_text(td) for td in tr.iterfind("td")]
+        if len(cells) >= width:
+            yield cells[:width]
+
+
+def parse_active_macs(page):
+    # rows of a netadmin.pl?maclist=<vlan> page
+    for cells in iter_table_rows(page, len(ActiveMac._fields)):
+        yield ActiveMac(*cells)
+
+
+def parse_nams(page):
+    # rows of a netadmin.pl?span=<vlan> page
+    for cells in iter_table_rows(page, len(NamPort._fields)):
+        yield NamPort(*cells)
+
+
+def parse_vlan_summary(page):
+    # (page title, [Vlan]) of the VLAN SUMMARY page; each VLAN is a <pre> block listing
+    # its name and tag, then first, last, gateway and netmask of its subnet
+    title = None
+    vlans = []
+    for elem in iter_elements(page, ("title", "pre")):
+        if elem.tag == "title":
+            title = elem.text or ""
+            continue
+        text = elem.text or ""
+        try:
+            subnet_info = text.split("Subnet Mask\n")[1].split("\n")[0].split()
+            vlan_arr = text.split("Tag\n")[1].split("____")[0].split()
+        except IndexError:
+            continue
+        if not vlan_arr:
+            continue
+
+        try:
+            subnet = str(ipaddress.IPv4Network((subnet_info[0], subnet_info[3]), False))
+        except Exception:
+            subnet = ""
+        vlans.append(Vlan(vlan_arr[0], vlan_arr[1] if len(vlan_arr) == 2 else "", subnet))
+    return title, vlans
@@ -0,0 +1,140 @@
+#! /usr/bin/python3
+
+import logging
+import random
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    key TEXT PRIMARY KEY,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+
+class Outbox:
+    """SQLite backed queue of outbound emails that survives crashes and reruns. """
+
+    def __init__(self, path, max_attempts=5, retry_delay=30.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def enqueue(self, key, sender, receiver, message):
+        # keys already queued or sent by an earlier run are left alone, so reruns resume instead of resending;
+        # callers put the content's identity in the key so a changed message gets a new key and is sent
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO outbox (key, sender, receiver, message, updated) VALUES (?, ?, ?, ?, ?)",
+                (key, sender, receiver, message, time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def recover(self):
+        # anything still marked sending was in flight when a previous run died
+        with self.db:
+            self.db.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+
+    def claim(self, limit):
+        now = time.time()
+        with self.db:
+            rows = self.db.execute(
+                "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE outbox SET status = 'sending', updated = ? WHERE key = ?",
+                [(now, row["key"]) for row in rows],
+            )
+        return rows
+
+    def mark_sent(self, key):
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL, updated = ? WHERE key = ?",
+                (time.time(), key),
+            )
+
+    def mark_failed(self, key, attempts, error):
+        attempts += 1
+        now = time.time()
+        if attempts >= self.max_attempts:
+            status, next_attempt = "failed", now
+        else:
+            # exponential backoff with jitter so a flapping server is not hit in lockstep
+            status = "pending"
+            next_attempt = now + self.retry_delay * 2 ** (attempts - 1) * random.uniform(0.8, 1.2)
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ?, updated = ? WHERE key = ?",
+                (status, attempts, next_attempt, str(error), now, key),
+            )
+        return status
+
+    def next_due(self):
+        row = self.db.execute("SELECT MIN(next_attempt) FROM outbox WHERE status = 'pending'").fetchone()
+        return row[0]
+
+    def counts(self):
+        rows = self.db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def retry_failed(self):
+        with self.db:
+            self.db.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt = 0 WHERE status = 'failed'"
+            )
+
+    async def deliver(self, send, concurrency=4, limiter=None, on_sent=None):
+        # send(sender, receiver, message) is a blocking callable such as Mailer.send; it runs in
+        # worker threads so up to `concurrency` messages are in flight at once. on_sent(key) is
+        # called once a message is safely marked as sent
+        import asyncio  # only loaded once there is something to deliver
+
+        self.recover()
+        while True:
+            batch = self.claim(concurrency)
+            if not batch:
+                due = self.next_due()
+                if due is None:
+                    break
+                await asyncio.sleep(max(0.0, due - time.time()))
+                continue
+            await asyncio.gather(*(self._deliver_one(row, send, limiter, on_sent) for row in batch))
+        return self.counts()
+
+    async def _deliver_one(self, row, send, limiter, on_sent):
+        import asyncio
+
+        if limiter:
+            await asyncio.to_thread(limiter.acquire)
+        try:
+            await asyncio.to_thread(send, row["sender"], row["receiver"], row["message"])
+        except Exception as e:
+            status = self.mark_failed(row["key"], row["attempts"], e)
+            if status == "failed":
+                logging.error("Giving up on %s after %s attempts: %s", row["key"], self.max_attempts, e)
+            else:
+                logging.warning("Sending %s failed, will retry: %s", row["key"], e)
+            return
+        self.mark_sent(row["key"])
+        if limiter:
+            limiter.record_sent()
+        if on_sent:
+            on_sent(row["key"])
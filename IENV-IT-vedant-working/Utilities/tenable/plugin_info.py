@@ -0,0 +1,97 @@
+#! /usr/bin/python3
+
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from http_session import pooled_session
+
+TENABLE_PLUGIN_URL = "https://security-center.ucdavis.edu/rest/plugin/"
+# only ask Tenable for what the reports use instead of the full plugin record
+PLUGIN_FIELDS = "name,synopsis,solution,riskFactor,baseScore,cvssV3BaseScore,exploitAvailable"
+DEFAULT_TTL = 7 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plugins (
+    plugin_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+"""
+
+
+def tenable_session(pool_size):
+    access_key = os.environ["API_KEY_TENABLE_ACCESS_KEY"]
+    secret_key = os.environ["API_KEY_TENABLE_SECRET_KEY"]
+
+    session = pooled_session(pool_size)
+    session.headers["x-apikey"] = "accesskey=" + access_key + "; secretkey=" + secret_key + ";"
+    return session
+
+
+class PluginInfo:
+    """Tenable plugin metadata, fetched concurrently once per plugin and cached on disk. """
+
+    def __init__(self, cache_path="./plugin_cache.sqlite3", ttl=DEFAULT_TTL, workers=8, session=None):
+        self.ttl = ttl
+        self.workers = workers
+        self.session = session
+        self.db = sqlite3.connect(cache_path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+        if self.session:
+            self.session.close()
+
+    def cached(self, plugin_ids):
+        oldest = time.time() - self.ttl
+        found = {}
+        plugin_ids = list(plugin_ids)
+        # stay well under SQLite's bound parameter limit
+        for i in range(0, len(plugin_ids), 500):
+            chunk = plugin_ids[i:i + 500]
+            rows = self.db.execute(
+                "SELECT plugin_id, data FROM plugins WHERE fetched >= ? AND plugin_id IN (%s)" % ",".join("?" * len(chunk)),
+                [oldest] + chunk,
+            ).fetchall()
+            found.update((plugin_id, json.loads(data)) for plugin_id, data in rows)
+        return found
+
+    def fetch(self, plugin_id):
+        r = self.session.get(TENABLE_PLUGIN_URL + plugin_id, params={"fields": PLUGIN_FIELDS}, timeout=30)
+        r.raise_for_status()
+        return r.json()["response"]
+
+    def fetch_many(self, plugin_ids):
+        # returns {plugin id: metadata} for every plugin that is cached or could be fetched;
+        # plugins Tenable couldn't be asked about are left out instead of ending the run
+        plugin_ids = {str(plugin_id) for plugin_id in plugin_ids}
+        results = self.cached(plugin_ids)
+        missing = sorted(plugin_ids - set(results))
+        if not missing:
+            return results
+
+        if self.session is None:
+            self.session = tenable_session(self.workers)
+        fetched = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch, plugin_id): plugin_id for plugin_id in missing}
+            for future in concurrent.futures.as_completed(futures):
+                plugin_id = futures[future]
+                try:
+                    results[plugin_id] = future.result()
+                except Exception as e:
+                    logging.warning("Couldn't get Tenable info for plugin ID %s: %s", plugin_id, e)
+                    continue
+                fetched.append((plugin_id, json.dumps(results[plugin_id]), time.time()))
+
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO plugins VALUES (?, ?, ?)", fetched)
+        return results
+
+    def get(self, plugin_id):
+        return self.fetch_many([plugin_id]).get(str(plugin_id))
@@ -0,0 +1,76 @@
+#! /usr/bin/python3
+
+import collections
+import threading
+import time
+
+
+class TokenBucket:
+    """Blocking token bucket that lets bursts through up to a send quota. """
+
+    def __init__(self, rate, per=60.0, burst=None):
+        # rate sends every per seconds, e.g. TokenBucket(30, 60) for Office365's 30 messages/minute.
+        # burst can only lower how many go out back to back: the sliding window below never
+        # lets more than rate through in any per seconds, so it is clamped to rate
+        self.rate = rate
+        self.per = per
+        self.capacity = min(burst or rate, rate)
+        self.tokens = float(self.capacity)
+        self.fill_rate = rate / per
+        self.last = time.monotonic()
+        self.sent = collections.deque()
+        self.total = 0  # confirmed sends, see record_sent()
+        self.started = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.fill_rate)
+        self.last = now
+        while self.sent and now - self.sent[0] >= self.per:
+            self.sent.popleft()
+
+    def wait_time(self, now):
+        # a full bucket refilling mid-window could let rate + 1 sends into a sliding window,
+        # so also hold off until the oldest send in the window has expired
+        wait = 0.0
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / self.fill_rate
+        if len(self.sent) >= self.rate:
+            wait = max(wait, self.per - (now - self.sent[0]))
+        return wait
+
+    def acquire(self):
+        # the lock is never held while sleeping, so record_sent() and the rate getters,
+        # which run on the event loop, don't stall behind a send waiting for a token
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.wait_time(now)
+                if wait <= 0:
+                    self.tokens -= 1
+                    self.sent.append(now)
+                    if self.started is None:
+                        self.started = now
+                    return
+            time.sleep(wait)
+
+    def record_sent(self):
+        # called once a send acquired from the bucket went through; a failed send still
+        # used up its slot in the quota but doesn't count towards average_rate()
+        with self._lock:
+            self.total += 1
+
+    def current_rate(self):
+        # sends in the trailing window, comparable to the provider's quota
+        with self._lock:
+            self._refill(time.monotonic())
+            return len(self.sent)
+
+    def average_rate(self):
+        # confirmed sends per `per` seconds since the first attempt
+        with self._lock:
+            if not self.started:
+                return 0.0
+            elapsed = time.monotonic() - self.started
+            return self.total * self.per / max(elapsed, self.per)
@@ -0,0 +1,121 @@
+#! /usr/bin/python3
+
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    snapshot TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    netbios TEXT NOT NULL,
+    dns TEXT NOT NULL,
+    mac TEXT NOT NULL,
+    PRIMARY KEY (snapshot, ip)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS findings (
+    snapshot TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    plugin_id TEXT NOT NULL,
+    severity TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (snapshot, ip, plugin_id)
+) WITHOUT ROWID;
+"""
+
+PREVIOUS = "previous"
+CURRENT = "current"
+
+
+class ScanSnapshot:
+    """Findings of the last processed scan, used to only report what changed since then. """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        # leftovers of a run that never committed
+        self._clear(CURRENT)
+
+    def close(self):
+        self.db.close()
+
+    def _clear(self, snapshot):
+        with self.db:
+            self.db.execute("DELETE FROM hosts WHERE snapshot = ?", (snapshot,))
+            self.db.execute("DELETE FROM findings WHERE snapshot = ?", (snapshot,))
+
+    def previous_findings(self, ip):
+        rows = self.db.execute(
+            "SELECT plugin_id, severity, name FROM findings WHERE snapshot = ? AND ip = ?", (PREVIOUS, ip)
+        ).fetchall()
+        return {plugin_id: (severity, name) for plugin_id, severity, name in rows}
+
+    def record(self, asset):
+        # left uncommitted until commit() so one scan is a single transaction
+        self.db.execute(
+            "INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?)",
+            (CURRENT, asset["IP"], asset["NetBIOS"], asset["DNS"], asset["MAC"]),
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO findings VALUES (?, ?, ?, ?, ?)",
+            [
+                (CURRENT, asset["IP"], plugin_id, severity, name)
+                for plugin_id, severity, name in zip(asset["Plugin IDs"], asset["Severities"], asset["Plugin Names"])
+            ],
+        )
+
+    def diff(self, asset):
+        # returns a copy of the asset holding only new or changed findings, with the plugins that
+        # disappeared since the previous scan in 'Resolved Plugin IDs'; None when nothing changed
+        previous = self.previous_findings(asset["IP"])
+        changed = {"Plugin IDs": [], "Severities": [], "Plugin Names": []}
+        current = set()
+        for plugin_id, severity, name in zip(asset["Plugin IDs"], asset["Severities"], asset["Plugin Names"]):
+            if plugin_id in current:
+                continue
+            current.add(plugin_id)
+            if previous.get(plugin_id) != (severity, name):
+                changed["Plugin IDs"].append(plugin_id)
+                changed["Severities"].append(severity)
+                changed["Plugin Names"].append(name)
+        resolved = sorted(set(previous) - current)
+        if not changed["Plugin IDs"] and not resolved:
+            return None
+        return dict(asset, **changed, **{"Resolved Plugin IDs": resolved})
+
+    def resolved_assets(self):
+        # hosts of the previous scan that no longer show up at all
+        rows = self.db.execute(
+            "SELECT ip, netbios, dns, mac FROM hosts WHERE snapshot = ? AND ip NOT IN "
+            "(SELECT ip FROM hosts WHERE snapshot = ?)",
+            (PREVIOUS, CURRENT),
+        ).fetchall()
+        for ip, netbios, dns, mac in rows:
+            yield {
+                "IP": ip,
+                "NetBIOS": netbios,
+                "DNS": dns,
+                "MAC": mac,
+                "Email Subject": ip + " (" + netbios.split("\\")[-1] + ") - Vulnerability List",
+                "Plugin IDs": [],
+                "Severities": [],
+                "Plugin Names": [],
+                "Resolved Plugin IDs": sorted(self.previous_findings(ip)),
+            }
+
+    def changed_assets(self, assets):
+        # wraps an asset iterable, recording every asset as the new snapshot and only yielding
+        # the ones that differ from the previous one, followed by hosts that were fully resolved
+        for asset in assets:
+            self.record(asset)
+            changes = self.diff(asset)
+            if changes:
+                yield changes
+        yield from self.resolved_assets()
+
+    def commit(self):
+        # the current scan becomes the baseline for the next run
+        with self.db:
+            self.db.execute("DELETE FROM hosts WHERE snapshot = ?", (PREVIOUS,))
+            self.db.execute("DELETE FROM findings WHERE snapshot = ?", (PREVIOUS,))
+            self.db.execute("UPDATE hosts SET snapshot = ? WHERE snapshot = ?", (PREVIOUS, CURRENT))
+            self.db.execute("UPDATE findings SET snapshot = ? WHERE snapshot = ?", (PREVIOUS, CURRENT))
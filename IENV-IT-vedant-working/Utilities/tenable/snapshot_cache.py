@@ -0,0 +1,106 @@
+#! /usr/bin/python3
+
+import concurrent.futures
+import json
+import logging
+import sqlite3
+import time
+
+# how long a record of each source is trusted before it is fetched again
+DEFAULT_TTLS = {
+    "coeitadmin": 7 * 24 * 3600,
+    "ucdnetwork": 24 * 3600,
+    "infoblox": 24 * 3600,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (source, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS snapshots_age ON snapshots (source, fetched);
+"""
+
+MISSING = object()
+
+
+class SnapshotCache:
+    """Local snapshot of enrichment lookups keyed by IP, MAC or hostname, with a TTL per source.
+
+    Lookups read through it first; an expired record is still returned when the
+    upstream API can't be reached, so runs keep working while it is slow or down.
+    """
+
+    def __init__(self, path="./enrichment_cache.sqlite3", ttls=None):
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def lookup(self, source, key):
+        # (value, fresh) or MISSING; a cached None means upstream had no record
+        row = self.db.execute(
+            "SELECT value, fetched FROM snapshots WHERE source = ? AND key = ?", (source, key)
+        ).fetchone()
+        if row is None:
+            return MISSING
+        value, fetched = row
+        return json.loads(value), time.time() - fetched < self.ttls.get(source, 0)
+
+    def put(self, source, key, value):
+        self.put_many(source, [(key, value)])
+
+    def put_many(self, source, items):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                [(source, key, json.dumps(value), now) for key, value in items],
+            )
+
+    def get(self, source, key, fetch):
+        cached = self.lookup(source, key)
+        if cached is not MISSING and cached[1]:
+            return cached[0]
+        try:
+            value = fetch(key)
+        except Exception:
+            if cached is MISSING:
+                raise
+            logging.warning("Using stale %s record for %s, upstream lookup failed", source, key)
+            return cached[0]
+        self.put(source, key, value)
+        return value
+
+    def stale_keys(self, source):
+        oldest = time.time() - self.ttls.get(source, 0)
+        rows = self.db.execute(
+            "SELECT key FROM snapshots WHERE source = ? AND fetched < ?", (source, oldest)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def refresh_stale(self, fetchers, workers=8):
+        # fetchers maps a source to fetch(key); every expired record of those sources is fetched again
+        # concurrently and written back in one transaction per source. Returns {source: (refreshed, failed)}
+        summary = {}
+        for source, fetch in fetchers.items():
+            keys = self.stale_keys(source)
+            refreshed = []
+            failed = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(fetch, key): key for key in keys}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        refreshed.append((futures[future], future.result()))
+                    except Exception as e:
+                        logging.warning("Couldn't refresh %s record for %s: %s", source, futures[future], e)
+                        failed += 1
+            self.put_many(source, refreshed)
+            summary[source] = (len(refreshed), failed)
+        return summary
@@ -1,37 +1,44 @@
 #!/usr/local/bin/python3
 
 import argparse
-#import requests
-import csv
+import concurrent.futures
 import getpass
+import hashlib
 import ipaddress
 import json
 import os
-import smtplib
-import ssl
 import time
-from pprint import pprint
 import pathlib
 
-# import infoblox_lookup as infoblox
-# import mynetwork
+# only what rendering reports offline needs is imported up front; sending (asyncio, smtplib,
+# ssl) and the API clients (requests) are imported where they are used to keep startup fast
+import asset_stream
+from scan_diff import ScanSnapshot
 
 
 def parse_config():
   parser = argparse.ArgumentParser(description='This script creates ServiceNow tickets for Tenable vulnerabilities.')
   parser.add_argument('configfile', help='Use the full file path for the JSON config file or move it to the same directory', type=argparse.FileType('r'))
   parser.add_argument('--send-emails', action='store_true', help='Flag to send emails')
+  parser.add_argument('--smtp-connections', type=int, default=2, help='Number of SMTP connections used to send emails concurrently (default: %(default)s)')
+  parser.add_argument('--diff', metavar='SNAPSHOT', help='Only report findings that are new, changed or resolved since the scan stored in this snapshot file, then store the current scan in it')
+  parser.add_argument('--plugin-info', action='store_true', help='Add CVSS scores and solutions from the Tenable API to each vulnerability (needs the keys from set_envs.sh); results are cached in plugin_cache.sqlite3')
+  parser.add_argument('--stream', action='store_true', help='Group the CSV with bounded memory, spilling partial assets to disk, and write each report as soon as its asset is complete')
+  parser.add_argument('--workers', type=int, default=1, help='Number of processes used to render and write the per-asset output files (default: %(default)s)')
+  parser.add_argument('--max-rows', type=int, default=asset_stream.DEFAULT_MAX_ROWS, help='Findings held in memory before spilling to disk when using --stream (default: %(default)s)')
 
   args = parser.parse_args()
 
   with args.configfile as file:
-    return json.load(file), args.send_emails
+    return json.load(file), args
 
 
 def get_all_vlans(username, password):
   #password = getpass.getpass(prompt="Please enter the password to your %s account: " % username)
+  import infoblox_lookup as infoblox # needs requests, only loaded when asked for
   print("Gathering VLAN info from InfoBlox...")
   ib = infoblox.InfoBlox(username, password)
+  ib.close()
   return ib.vlans
 
 
@@ -42,6 +49,8 @@ def setup_server_connection(sender):
   timeout = 10800 #in seconds; increasing to 3 hours as a test
   password = getpass.getpass(prompt="Please enter the password to the %s account: " % sender) 
   
+  import smtplib
+  import ssl
   context = ssl.create_default_context() #context = ssl.SSLContext(ssl.PROTOCOL_TLS)
   #print("Setting up connection to Office365...")
   
@@ -56,70 +65,23 @@ def setup_server_connection(sender):
     exit()
 
 
-def get_tenable_vuln_info(pluginid):
-  access_key = os.environ["API_KEY_TENABLE_ACCESS_KEY"]
-  secret_key = os.environ["API_KEY_TENABLE_SECRET_KEY"]
-  
-  url = 'https://security-center.ucdavis.edu/rest/plugin/' + pluginid
-  apikey_string = 'accesskey=' + access_key + '; secretkey=' + secret_key + ';'
-  headers = { 'x-apikey' : apikey_string }
-  
-  try:
-    r = requests.get(url, headers=headers, verify=False)
-    r.raise_for_status()
-    data = r.json()
-    return data
-  except Exception as e:
-    print(e)
-    print("Something failed with the get request to Tenable for plugin ID %s" % pluginid)
-    exit()
-
-
-def get_ad_computer_info(hostname):
-  coe_it_key = os.environ["API_KEY_COEITADMIN_TOOLS"]
-
-  url = 'https://coeitadmin.engr.ucdavis.edu/api/ucomputer/' + hostname
-  headers = { 'coe-api-key' : coe_it_key }
-
-  try:
-    r = requests.get(url, headers=headers, verify=False)
-    r.raise_for_status()
-    data = r.json()
-    return data
-  except Exception as e:
-    print(e)
-    print("Something failed with the get request to coeitadmin tools for computer with hostname %s" % hostname)
-    exit()
-
-
-def get_ucdnetwork_info(ip):
-  ucdnetwork_key = os.environ["API_KEY_UCDNETWORK"]
-  
-  url = 'https://ucdnetwork.engr.ucdavis.edu/devices?ip=' + ip
-  headers = { 'accept' : 'application/json' , 'X-APIf-KEY' : ucdnetwork_key }
-
-  try:
-    r = requests.get(url, headers=headers, verify=False)
-    r.raise_for_status()
-    data = r.json()
-    return data
-  except Exception as e:
-    print(e)
-    print("Something failed with the get request to ucdnetwork for computer info for ip %s" % ip)
-    exit()
-
-
 def generate_email_body(asset, vlan_name, signature):
   vuln_links = []
   
   # for plugin_id,  in set(asset['Plugin IDs']):
   for plugin_id, severity, name in zip(asset['Plugin IDs'], asset['Severities'], asset['Plugin Names']):
-    #data = get_tenable_vuln_info(plugin_id)
-    #vuln_name = data['response']['name']
     vuln_name = ""
     # vuln_link = "https://www.tenable.com/plugins/nessus/" + str(plugin_id) + "" + vuln_name + " (Plugin ID: " + str(plugin_id) + ")"
     
     vuln_link = f'[code]<a href="https://www.tenable.com/plugins/nessus/{plugin_id}" target="_blank">{name}</a>[/code] \n PLugin ID: {plugin_id} \n Severity: {severity}\n' 
+    # Tenable metadata attached by --plugin-info
+    info = asset.get('Plugin Info', {}).get(plugin_id)
+    if info:
+      cvss = info.get('cvssV3BaseScore') or info.get('baseScore')
+      if cvss:
+        vuln_link += f' CVSS: {cvss}\n'
+      if info.get('solution'):
+        vuln_link += f' Solution: {info["solution"].strip()}\n'
     vuln_links.append(vuln_link)
 
   if asset["NetBIOS"]:
@@ -152,6 +114,10 @@ def generate_email_body(asset, vlan_name, signature):
   [code]<b class="term">Vulnerabilities:</b>[/code]
   """ + '\n'.join(vuln_links)
 
+  if asset.get('Resolved Plugin IDs'):
+    email_body += "\n  [code]<b class=\"term\">Resolved since the last scan:</b>[/code]\n" \
+                  + '\n'.join(" Plugin ID: %s" % plugin_id for plugin_id in asset['Resolved Plugin IDs'])
+
   # email_body = email_body_pre_vlan + email_body_vlan + email_body_post_vlan + email_body_vuln_links
   return email_body
 
@@ -164,48 +130,151 @@ def send_email(ip, sender, receiver, message, server):
     print("Couldn't send email for asset IP: " % ip)
 
 
-#Necessary imports for sending emails
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
-import os
+def build_message(sender_email, receiver_email, subject, body):
+    #Necessary imports for sending emails, loaded on the first email only
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    # Create message container
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = receiver_email
+    msg['Subject'] = subject
+
+    # Attach body as email text
+    msg.attach(MIMEText(body, 'plain'))
+    return msg
+
 
 #Function for sending emails with attachments
-def send_email_with_attachments(sender_email, password, receiver_email, subject, body):
-    # Email configuration
-    smtp_server = 'smtp.gmail.com'
-    port = 587
-    username = sender_email
-    password = password
+def send_email_with_attachments(sender_email, password, receiver_email, subject, body, mailer=None):
+    msg = build_message(sender_email, receiver_email, subject, body)
+    print(body)
 
-    # Establish connection with SMTP server
+    # Send the email with file contents in the body, reusing the caller's connections when given a mailer
     try:
-        server = smtplib.SMTP(smtp_server, port)
-        server.starttls()
-        server.login(username, password)
-
-        # Create message container
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = receiver_email
-        msg['Subject'] = subject
-        
-        print(body)
-        # Attach body as email text
-        msg.attach(MIMEText(body, 'plain'))
-
-        # Send the email with file contents in the body
-        text = msg.as_string()
-        server.sendmail(sender_email, receiver_email, text)
+        if mailer:
+            mailer.send(sender_email, receiver_email, msg)
+        else:
+            with setup_mailer(sender_email, password, pool_size=1) as one_off:
+                one_off.send(sender_email, receiver_email, msg)
         print('Email sent successfully!')
     except Exception as e:
         print(f"Error: {e}")
-    finally:
-        server.quit()
+
+
+def setup_mailer(sender_email, password, pool_size=2):
+    # Email configuration
+    smtp_server = 'smtp.gmail.com'
+    port = 587
+    from mailer import Mailer
+    return Mailer(smtp_server, port, sender_email, password, pool_size=pool_size)
+
+
+# bump whenever generate_email_body changes so every cached report gets re-rendered
+TEMPLATE_VERSION = 1
+MANIFEST_FILE = '.manifest.json'
+
+
+def report_filename(asset):
+  return asset['DNS'] or asset['IP']
+
+
+def report_digest(asset, vlan_name, signature):
+  # hash of everything the rendered report depends on; findings are sorted so the CSV's row order doesn't matter
+  findings = sorted(set(zip(asset['Plugin IDs'], asset['Severities'], asset['Plugin Names'])))
+  key = [TEMPLATE_VERSION, asset['IP'], asset['NetBIOS'], asset['DNS'], asset['MAC'], asset['Email Subject'],
+         findings, asset.get('Resolved Plugin IDs', []), asset.get('Plugin Info', {}), vlan_name, signature]
+  return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(output_folder):
+  try:
+    with open(os.path.join(output_folder, MANIFEST_FILE), 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def save_manifest(output_folder, manifest):
+  manifest_path = os.path.join(output_folder, MANIFEST_FILE)
+  with open(manifest_path + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_report(asset, output_folder):
+  with open(os.path.join(output_folder, report_filename(asset)), 'r') as f:
+    return f.read()
+
+
+def write_report(asset, output_folder, vlan_name, signature):
+  output_file_path = os.path.join(output_folder, report_filename(asset))
+  message = "HOST INFORMATION: \n" + "%s\r\n" % asset['Email Subject'] \
+            + generate_email_body(asset, vlan_name, signature)
+  # Write to a temporary file first so concurrent workers never leave a half written report behind
+  tmp_file_path = "%s.%d.tmp" % (output_file_path, os.getpid())
+  with open(tmp_file_path, 'w') as f:
+    f.write(message)
+  os.replace(tmp_file_path, output_file_path)
+  return message
+
+
+def render_reports(assets, output_folder, vlan_name, signature, workers, manifest):
+  # yields (asset, message) pairs, in completion order when using more than one worker. Assets whose
+  # report in the manifest has the same digest are not rendered again and yield None as their message
+  def outdated():
+    for asset in assets:
+      name = report_filename(asset)
+      digest = report_digest(asset, vlan_name, signature)
+      if manifest.get(name) == digest and os.path.exists(os.path.join(output_folder, name)):
+        yield asset, None
+      else:
+        yield asset, digest
+
+  if workers <= 1:
+    for asset, digest in outdated():
+      if digest is None:
+        yield asset, None
+        continue
+      message = write_report(asset, output_folder, vlan_name, signature)
+      manifest[report_filename(asset)] = digest
+      yield asset, message
+    return
+
+  # only keep a few batches in flight so a streamed CSV is never fully materialized
+  max_pending = workers * 4
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+    pending = {}
+
+    def finished(future):
+      asset, digest = pending.pop(future)
+      message = future.result()
+      manifest[report_filename(asset)] = digest
+      return asset, message
+
+    for asset, digest in outdated():
+      if digest is None:
+        yield asset, None
+        continue
+      future = executor.submit(write_report, asset, output_folder, vlan_name, signature)
+      pending[future] = (asset, digest)
+      if len(pending) >= max_pending:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          yield finished(future)
+    for future in concurrent.futures.as_completed(list(pending)):
+      yield finished(future)
+
+
+def with_plugin_info(assets, plugins):
+  for asset in assets:
+    asset['Plugin Info'] = {plugin_id: plugins[plugin_id] for plugin_id in set(asset['Plugin IDs']) if plugin_id in plugins}
+    yield asset
+
 
 def main():
-  config_data, send_emails = parse_config()
+  config_data, args = parse_config()
   username = config_data['kerberosID']
   sender = config_data['sender']
   password = config_data['password']
@@ -223,80 +292,99 @@ def main():
   # Create the output folder if it doesn't exist
   os.makedirs(output_folder, exist_ok=True)
 
-  ticket_ips = []
-  
-  with open("./ticket_ips.txt", 'r') as file:
-    reader = csv.reader(file)
-    for row in reader:
-      ticket_ips = row #file is a list of comma separated ips so row is a list
+  queued = {} #outbox key -> plugin ids so tickets are recorded once actually sent
   
   vlans = None
   # password = "" #default, if username not provided, remains empty
   
-  assets = {}
   # MyNetwork_data = None
   # if password:
   #   #added for location data
+  #   import mynetwork
   #   MyNetwork_data = mynetwork.MyNetwork(username, password, 'testing')
-  
-  with open(vuln_filename, 'r') as file:
-    csv_reader2 = csv.DictReader(file)
-    
-    for row in csv_reader2:
-      ip = row['IP Address']
-      # print("This is the IP of the vuln computer: ", ip, "\n")
-      if ip in assets.keys():
-        assets[ip]['Plugin IDs'].append(row['Plugin'])
-        assets[ip]['Severities'].append(row['Severity'])
-      else:
-        assets.update({ip : {}})
-        assets[ip]['IP'] = ip
-        assets[ip]['NetBIOS'] = row['NetBIOS Name']
-        assets[ip]['DNS'] = row['DNS Name']
-        assets[ip]['MAC'] = row['MAC Address']
-        # assets[ip]['Email Subject'] = ip + " (" + assets[ip]['NetBIOS'] + ") - Vulnerability List"
-        assets[ip]['Email Subject'] = ip + " (" + assets[ip]['NetBIOS'].split('\\')[-1] + ") - Vulnerability List"
-        assets[ip]['Plugin IDs'] = [ row['Plugin'] ]
-        assets[ip]['Severities'] = [ row['Severity'] ]
-        assets[ip]['Plugin Names'] = [ row['Plugin Name'] ]
+
+  if args.stream:
+    assets = asset_stream.iter_assets(vuln_filename, args.max_rows)
+  else:
+    assets = asset_stream.read_assets(vuln_filename)
+
+  snapshot = None
+  if args.diff:
+    snapshot = ScanSnapshot(args.diff)
+    assets = snapshot.changed_assets(assets)
+
+  if args.plugin_info:
+    from plugin_info import PluginInfo # needs requests, only loaded when asked for
+    plugin_info = PluginInfo()
+    # one pass over the plugin column so every plugin is fetched once, concurrently, before rendering starts
+    plugins = plugin_info.fetch_many(asset_stream.plugin_ids(vuln_filename))
+    plugin_info.close()
+    assets = with_plugin_info(assets, plugins)
 
   count = 0 #server connection
   emails_sent = 0 #number of emails sent
   vlan_name = ""
+  # emails are queued on disk next to the reports so an interrupted run picks up where it stopped
+  outbox = None
+  tickets = None
+  if args.send_emails:
+    from outbox import Outbox
+    from ticket_store import TicketStore
+    outbox = Outbox(os.path.join(output_folder, 'outbox.sqlite3'))
+    # ip/plugin pairs that already have tickets; ticket_ips.txt is still honoured as whole host entries
+    tickets = TicketStore(config_data.get('ticket_db', './tickets.sqlite3'))
+    tickets.import_ip_list("./ticket_ips.txt")
   
-  for ip in assets.keys():
+  # digests of the reports already in the output folder, so unchanged assets skip rendering and I/O
+  manifest = load_manifest(output_folder)
+  reports_reused = 0
+
+  for asset, message in render_reports(assets, output_folder, vlan_name, signature, args.workers, manifest):
     vlan_cs = "ENG-CMPR-SCI-7" #to fix error/value doesn't matter hopefully?
     
     ### start location code ###
     # if password:
-    #   assets[ip]['Location'] = "Unknown"
+    #   asset['Location'] = "Unknown"
     #   for item in MyNetwork_data.get_active_macs(vlan_cs):
-    #     if item['mac'] == assets[ip]['MAC']:
-    #       assets[ip]['Location'] = item['building'] + " " + item['room']
+    #     if item['mac'] == asset['MAC']:
+    #       asset['Location'] = item['building'] + " " + item['room']
     #       break
     
     ### end location code ###
 
-    ## Checking if output files already exists
-    output_file_path = os.path.join(output_folder, assets[ip]['DNS'])
-    if os.path.exists(output_file_path):
-        with open(output_file_path, 'r') as f:
-            message = f.read()
-    else:
-        message = "HOST INFORMATION: \n" + "%s\r\n" % assets[ip]['Email Subject'] \
-                  + generate_email_body(assets[ip], vlan_name, signature)
-        # Write the message to the output file
-        with open(output_file_path, 'w') as f:
-            f.write(message)
+    if message is None:
+      reports_reused = reports_reused + 1
 
     # Send the email using either the existing or newly created output file
-    subject = assets[ip]['Email Subject']
-    if send_emails:
-        send_email_with_attachments(sender, password, receiver, subject, message)
+    subject = asset['Email Subject']
+    if outbox and (asset.get('Resolved Plugin IDs') or not tickets.has_ticket(asset['IP'], asset['Plugin IDs'])):
+        if message is None:
+          message = read_report(asset, output_folder)
+        # keyed by the report's digest too, so a host is emailed again once its report changes
+        key = asset['IP'] + ":" + report_digest(asset, vlan_name, signature)
+        outbox.enqueue(key, sender, receiver, build_message(sender, receiver, subject, message).as_string())
+        queued[key] = (asset['IP'], asset['Plugin IDs'])
 
     emails_sent = emails_sent + 1
     print("%s files created. Exiting..." % emails_sent)
 
+  save_manifest(output_folder, manifest)
+  print("%s of them unchanged since the last run and reused." % reports_reused)
+
+  if snapshot:
+    snapshot.commit()
+    snapshot.close()
+
+  if outbox:
+    import asyncio
+    outbox.retry_failed()
+    sent_before = outbox.counts().get('sent', 0)
+    with setup_mailer(sender, password, args.smtp_connections) as mailer:
+      counts = asyncio.run(outbox.deliver(mailer.send, concurrency=args.smtp_connections,
+                                          on_sent=lambda key: key in queued and tickets.record(*queued[key])))
+    outbox.close()
+    tickets.close()
+    print("%s email(s) sent, %s failed. Rerun to retry failed emails." % (counts.get('sent', 0) - sent_before, counts.get('failed', 0)))
 
 
 
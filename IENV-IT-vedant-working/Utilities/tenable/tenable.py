@@ -1,165 +1,136 @@
 #!/usr/local/bin/python3
 
-import requests
 import argparse
 import csv
 import getpass
-import ipaddress
+import hashlib
 import json
-import os
-import smtplib
-import ssl
-import time
-from pprint import pprint
 
-import infoblox_lookup as infoblox
-import mynetwork
+# infoblox_lookup, mynetwork, enrichment and plugin_info pull in requests, selenium and bs4,
+# and mailer, outbox and asyncio are only needed to send, so they are imported by the code
+# that needs them instead of on every start
+from ratelimit import TokenBucket
+from snapshot_cache import SnapshotCache
+from ticket_store import TicketStore
+from vlan_index import VlanIndex
+
+
+# CS hosts in these subnets are looked up in MyNetwork under ENG-CMPR-SCI-7
+CS_VLANS = VlanIndex({
+  '169.237.4.0/24': "ENG-CMPR-SCI-7",
+  '169.237.6.0/24': "ENG-CMPR-SCI-7",
+  '169.237.7.0/24': "ENG-CMPR-SCI-7",
+  '169.237.10.0/24': "ENG-CMPR-SCI-7",
+})
 
 
 def parse_config():
   parser = argparse.ArgumentParser(description='This script creates ServiceNow tickets for Tenable vulnerabilities.')
   parser.add_argument('configfile', help='Use the full file path for the JSON config file or move it to the same directory', type=argparse.FileType('r'))
+  parser.add_argument('--refresh-stale', action='store_true', help='Re-fetch every expired record in the enrichment snapshot cache, then exit')
 
   args = parser.parse_args()
 
   with args.configfile as file:
-    return json.load(file)
+    return json.load(file), args
+
+
+def refresh_stale(config_data, cache):
+  import infoblox_lookup as infoblox
+  from enrichment import HostEnricher
+  print("Refreshing stale host info in %s..." % cache.path)
+  hosts = HostEnricher(config_data.get('enrich_workers', 8), cache=cache)
+  summary = hosts.refresh_stale()
+  hosts.close()
+
+  username = config_data['kerberosID']
+  stale = cache.stale_keys("infoblox")
+  if username.strip() and stale:
+    password = getpass.getpass(prompt="Please enter the password to your %s account: " % username)
+    ib = infoblox.InfoBlox(username, password, cache)
+    # addresses of a failed batch are left out, the ones InfoBlox has no record of come back as None
+    fetched = ib.fetch_ips(stale)
+    ib.close()
+    cache.put_many("infoblox", fetched.items())
+    summary["infoblox"] = (len(fetched), len(stale) - len(fetched))
+
+  for source, (refreshed, failed) in summary.items():
+    print("%s: %s refreshed, %s failed" % (source, refreshed, failed))
 
 
 def get_all_vlans(username, password):
   #password = getpass.getpass(prompt="Please enter the password to your %s account: " % username)
+  import infoblox_lookup as infoblox
   print("Gathering VLAN info from InfoBlox...")
   ib = infoblox.InfoBlox(username, password)
+  ib.close()
   return ib.vlans
 
 
-def setup_server_connection(sender):
+def setup_server_connection(sender, pool_size=2):
+  from mailer import Mailer
   smtp_server = 'smtp.office365.com'
   port = 25 #25
   #timeout = 3000 #in seconds
   timeout = 10800 #in seconds; increasing to 3 hours as a test
   password = getpass.getpass(prompt="Please enter the password to the %s account: " % sender)
   
-  context = ssl.create_default_context() #context = ssl.SSLContext(ssl.PROTOCOL_TLS)
   #print("Setting up connection to Office365...")
+  server = Mailer(smtp_server, port, sender, password, pool_size=pool_size, timeout=timeout)
   
   try:
-    with smtplib.SMTP(smtp_server, port) as server:
-      server.starttls(context=context)
-      server.login(sender, password)
-      return server
+    server.release(server.acquire()) #log in once up front so bad credentials fail before sending starts
+    return server
   except Exception as e:
     print(e)
     print("Couldn't connect to Office365 account %s" % sender)
     exit()
 
 
-def get_tenable_vuln_info(pluginid):
-  access_key = os.environ["API_KEY_TENABLE_ACCESS_KEY"]
-  secret_key = os.environ["API_KEY_TENABLE_SECRET_KEY"]
-  
-  url = 'https://security-center.ucdavis.edu/rest/plugin/' + pluginid
-  apikey_string = 'accesskey=' + access_key + '; secretkey=' + secret_key + ';'
-  headers = { 'x-apikey' : apikey_string }
-  
-  try:
-    r = requests.get(url, headers=headers, verify=False)
-    r.raise_for_status()
-    data = r.json()
-    return data
-  except Exception as e:
-    print(e)
-    print("Something failed with the get request to Tenable for plugin ID %s" % pluginid)
-    exit()
-
-
-def get_ad_computer_info(hostname):
-  coe_it_key = os.environ["API_KEY_COEITADMIN_TOOLS"]
-
-  url = 'https://coeitadmin.engr.ucdavis.edu/api/ucomputer/' + hostname
-  headers = { 'coe-api-key' : coe_it_key }
-
-  try:
-    r = requests.get(url, headers=headers, verify=False)
-    r.raise_for_status()
-    data = r.json()
-    return data
-  except Exception as e:
-    print(e)
-    print("Something failed with the get request to coeitadmin tools for computer with hostname %s" % hostname)
-    exit()
-
-
-def get_ucdnetwork_info(ip):
-  ucdnetwork_key = os.environ["API_KEY_UCDNETWORK"]
-  
-  url = 'https://ucdnetwork.engr.ucdavis.edu/devices?ip=' + ip
-  headers = { 'accept' : 'application/json' , 'X-APIf-KEY' : ucdnetwork_key }
-
-  try:
-    r = requests.get(url, headers=headers, verify=False)
-    r.raise_for_status()
-    data = r.json()
-    return data
-  except Exception as e:
-    print(e)
-    print("Something failed with the get request to ucdnetwork for computer info for ip %s" % ip)
-    exit()
-
-
-def generate_email_body(asset, vlan_name, signature):
+def generate_email_body(asset, vlan_name, signature, plugins=None, hosts=None):
   vuln_links = []
   
   for plugin_id in set(asset['Plugin IDs']):
-    #data = get_tenable_vuln_info(plugin_id)
-    #vuln_name = data['response']['name']
-    vuln_name = ""
+    # plugins holds Tenable's metadata, prefetched for the whole scan by PluginInfo.fetch_many
+    vuln_name = (plugins or {}).get(plugin_id, {}).get('name', "")
     vuln_links.append("<a href=\"https://www.tenable.com/plugins/nessus/" + str(plugin_id) + "\">" + vuln_name + "</a> (Plugin ID: " + str(plugin_id) + ")")
   
-  if asset["NetBIOS"]:
-    hostname = asset["NetBIOS"].split("\\")[1]
-  else:
-    hostname = ""
-  '''
-  if hostname:
-    coeitadmin_data = get_ad_computer_info(hostname)
-    if coeitadmin_data:
-      coeitadmin_os = coeitadmin_data.get("os")
-      coeitadmin_dn = coeitadmin_data.get("dn")
-    else:
-      coeitadmin_os = 'No record in Active Directory/coeitadmin'
-      coeitadmin_dn = 'No record in Active Directory/coeitadmin'
-  else:
-    coeitadmin_os = 'No hostname specified'
-    coeitadmin_dn = 'No hostname specified'
-
-  ucdnetwork_data = get_ucdnetwork_info(asset['IP'])
-  
-  print(ucdnetwork_data)
-  if ucdnetwork_data:
-    ucdn_name = ucdnetwork_data[0].get("name")
-    print("hostname" + ucdn_name)
-    if ucdnetwork_data[0].get("building"): #accounting for a possible None type
-      ucdn_location = ucdnetwork_data[0].get("building") + " " + ucdnetwork_data[0].get("room")
+  # hosts is a HostEnricher that already fetched coeitadmin and ucdnetwork for every asset; misses are soft
+  email_body_host_info = ""
+  if hosts:
+    from enrichment import asset_hostname
+    hostname = asset_hostname(asset)
+    if hostname:
+      coeitadmin_data = hosts.ad_info(hostname)
+      if coeitadmin_data:
+        coeitadmin_os = coeitadmin_data.get("os") or ""
+        coeitadmin_dn = coeitadmin_data.get("dn") or ""
+      else:
+        coeitadmin_os = 'No record in Active Directory/coeitadmin'
+        coeitadmin_dn = 'No record in Active Directory/coeitadmin'
     else:
-      ucdn_location = ""
-    print("location" + ucdn_location)
-    ucdn_mac = ucdnetwork_data[0].get("mac")
-    print("mac " + ucdn_mac)
-    if ucdnetwork_data[0].get("last_seen"):
-      ucdn_last_seen = ucdnetwork_data[0].get("last_seen")
+      coeitadmin_os = 'No hostname specified'
+      coeitadmin_dn = 'No hostname specified'
+
+    ucdnetwork_data = hosts.ucdnetwork_info(asset['IP'])
+    if ucdnetwork_data:
+      ucdn_name = ucdnetwork_data.get("name") or ""
+      if ucdnetwork_data.get("building"): #accounting for a possible None type
+        ucdn_location = ucdnetwork_data.get("building") + " " + (ucdnetwork_data.get("room") or "")
+      else:
+        ucdn_location = ""
+      ucdn_last_seen = ucdnetwork_data.get("last_seen") or ""
+      ucdn_comment = ucdnetwork_data.get("comment") or ""
     else:
-      ucdn_last_seen = ""
-    print("last seen " + ucdn_last_seen)
-    ucdn_comment = ucdnetwork_data[0].get("comment")
-    print("comment" + ucdn_comment)
-  else:
-    ucdn_name = 'No record in ucdnetwork'
-    ucdn_location = 'No record in ucdnetwork'
-    ucdn_mac = 'No record in ucdnetwork'
-    ucdn_last_seen = 'No record in ucdnetwork'
-    ucdn_comment = 'No record in ucdnetwork'
-'''  
+      ucdn_name = 'No record in ucdnetwork'
+      ucdn_location = 'No record in ucdnetwork'
+      ucdn_last_seen = 'No record in ucdnetwork'
+      ucdn_comment = 'No record in ucdnetwork'
+
+    email_body_host_info = "<br>Operating System: " + coeitadmin_os + "<br>AD Location: " + coeitadmin_dn \
+                           + "<br>ucdnetwork Name: " + ucdn_name + "<br>Location: " + ucdn_location \
+                           + "<br>Last Seen: " + ucdn_last_seen + "<br>Comment: " + ucdn_comment
+
   email_body_pre_vlan = "[code]System " + asset['IP'] + " needs to be upgraded or the impacted service removed from the network. It is running an exploitable service and is in violation of UC Davis network policy.<br><br>Please note that COE practice is remediation of critical and high vulnerabilities such as these within 14 days. If you have determined that one or more of the listed vulnerabilities are false positives, please respond to this incident with the specific plugin ID/IP address of each of the false positives along with an explanation of why they are false positives.<br><br>If you need to obtain an exception for a particular vulnerability or device, please follow the Cyber-Safety Exception process outlined at <a href=\"http://kb.ucdavis.edu/?id=0700\">http://kb.ucdavis.edu/?id=0700</a>.<br><br><b><u>Please answer the following questions before closing this ticket:</b></u><ol><li>Does COE IT administrate this system? Who is the primary contact for this system?</li><li>Please have the owner of this system fill out a <a href=\"https://servicehub.ucdavis.edu/servicehub?id=ucd_cat_item&sys_id=945a503c13bd77009c41bb722244b083\">Network Registration form</a> to determine if there is <a href=\"https://kb.ucdavis.edu/?id=6684\">PII</a> or sensitive data on this system as well as the types of data present. If you have questions about data protection levels, please consult <a href=\"https://security.ucop.edu/files/documents/uc-protection-level-classification-guide.pdf\">UCOP's guide on the subject</a>.</li></ol><b><u>Host Information</b></u><br>IP Address: " + asset['IP']
   
   if vlan_name:
@@ -167,7 +138,7 @@ def generate_email_body(asset, vlan_name, signature):
   else:
     email_body_vlan = ""
 
-  email_body_post_vlan = "<br>NetBIOS Name: " + asset['NetBIOS'] + "<br>DNS: " + asset['DNS'] + "<br>MAC Address: " + asset['MAC'] + "<br><br><b><u>Vulnerabilities</b></u><br>"
+  email_body_post_vlan = "<br>NetBIOS Name: " + asset['NetBIOS'] + "<br>DNS: " + asset['DNS'] + "<br>MAC Address: " + asset['MAC'] + email_body_host_info + "<br><br><b><u>Vulnerabilities</b></u><br>"
   
   separator = "<br>"
   email_body_vuln_links = "" + separator.join(vuln_links) + "[/code]"
@@ -176,21 +147,21 @@ def generate_email_body(asset, vlan_name, signature):
   return email_body
 
 
-def send_email(ip, sender, receiver, message, server):
-  try:
-    server.sendmail(sender, receiver, message)
-  except Exception as e:
-    print(e)
-    print("Couldn't send email for asset IP: " % ip)
-
-
 def main():
-  config_data = parse_config()
+  config_data, args = parse_config()
+  # last known coeitadmin/ucdnetwork/InfoBlox answers, so unchanged hosts aren't looked up on every run
+  enrichment_cache = SnapshotCache(config_data.get('enrichment_cache', './enrichment_cache.sqlite3'))
+  if args.refresh_stale:
+    refresh_stale(config_data, enrichment_cache)
+    enrichment_cache.close()
+    return
   username = config_data['kerberosID']
   sender = config_data['sender']
   receiver = config_data['receiver']
   signature = config_data['signature']
   vuln_filename = config_data['csv_file']
+  # Office365 allows 30 messages per minute; messages_burst (at most that rate) caps how many go out back to back
+  send_limit = TokenBucket(config_data.get('messages_per_minute', 30), 60, config_data.get('messages_burst'))
   #vuln_folder = config_data['folder']
   '''internet_exposed_ips_filename = config_data['internet_exposed_ips']
   
@@ -201,12 +172,11 @@ def main():
     for row in reader:
       internet_exposed_ips = row #file is a list of comma separated ips so row is a list
   '''
-  ticket_ips = []
-  
-  with open("./ticket_ips.txt", 'r') as file:
-    reader = csv.reader(file)
-    for row in reader:
-      ticket_ips = row #file is a list of comma separated ips so row is a list
+  # ip/plugin pairs that already have tickets; ticket_ips.txt is still honoured as whole host entries
+  tickets = TicketStore(config_data.get('ticket_db', './tickets.sqlite3'))
+  tickets.import_ip_list("./ticket_ips.txt")
+  queued = {} #outbox key -> (ip, plugin ids) so tickets are recorded once actually sent
+  pending = [] #(outbox key, message) of every host that still needs an email
   
   vlans = None
   password = "" #default, if username not provided, remains empty
@@ -223,6 +193,7 @@ def main():
   MyNetwork_data = None
   if password:
     #added for location data
+    import mynetwork
     MyNetwork_data = mynetwork.MyNetwork(username, password, 'testing')
   
   with open(vuln_filename, 'r') as file:
@@ -247,29 +218,41 @@ def main():
           else:
             assets[ip]['Internet Exposed'] = "No"
         '''
-  count = 0 #server connection
-  emails_sent = 0 #number of emails sent
   vlan_name = ""
   
+  plugins = None
+  if config_data.get('plugin_info'): # needs the Tenable API keys from set_envs.sh
+    from plugin_info import PluginInfo
+    plugin_info = PluginInfo(config_data.get('plugin_cache', './plugin_cache.sqlite3'))
+    plugins = plugin_info.fetch_many({plugin_id for asset in assets.values() for plugin_id in asset['Plugin IDs']})
+    plugin_info.close()
+  
+  hosts = None
+  if config_data.get('enrich_hosts'): # needs the coeitadmin and ucdnetwork API keys
+    print("Gathering host info from coeitadmin and ucdnetwork...")
+    from enrichment import HostEnricher
+    hosts = HostEnricher(config_data.get('enrich_workers', 8), cache=enrichment_cache)
+    hosts.prefetch(assets.values())
+  
+  # built once so each asset's VLAN is a single longest-prefix lookup instead of a pass over every network
+  vlan_index = VlanIndex(vlans) if vlans else None
+  vlan_names = vlan_index.resolve_many(assets.keys()) if vlan_index else {}
+  
   for ip in assets.keys():
     vlan_cs = "ENG-CMPR-SCI-7" #to fix error/value doesn't matter hopefully?
-    '''if vlans:
-      for key in vlans.keys():
-        if (ipaddress.ip_address(ip) in ipaddress.ip_network(key)):
-          vlan_name = vlans[key]
-          vlan_cs = vlans[key]
-        if ((ipaddress.ip_address(ip) in ipaddress.ip_network('169.237.4.0/24')) or (ipaddress.ip_address(ip) in ipaddress.ip_network('169.237.10.0/24')) or (ipaddress.ip_address(ip) in ipaddress.ip_network('169.237.6.0/24')) or (ipaddress.ip_address(ip) in ipaddress.ip_network('169.237.7.0/24'))):
-          vlan_cs = "ENG-CMPR-SCI-7"
-    else:
-      vlan_name = ""  '''
+    if vlan_index:
+      vlan_name = vlan_names[ip] or ""
+      vlan_cs = CS_VLANS.lookup(ip) or vlan_name or vlan_cs
     
     ### start location code ###
     if password:
-      assets[ip]['Location'] = "Unknown"
-      for item in MyNetwork_data.get_active_macs(vlan_cs):
-        if item['mac'] == assets[ip]['MAC']:
-          assets[ip]['Location'] = item['building'] + " " + item['room']
-          break
+      if not vlan_index: # without InfoBlox, MyNetwork's own VLAN summary knows every subnet
+        vlan = MyNetwork_data.vlan_for_ip(ip)
+        if vlan:
+          vlan_cs = CS_VLANS.lookup(ip) or vlan['name']
+      # each VLAN's MAC table is scraped once and indexed, not once per asset
+      item = MyNetwork_data.locate_mac(vlan_cs, assets[ip]['MAC'])
+      assets[ip]['Location'] = item['building'] + " " + item['room'] if item else "Unknown"
     
     ### end location code ###
     
@@ -277,30 +260,41 @@ def main():
                 + "To: %s\r\n" % receiver \
                 + "Subject: %s\r\n" % assets[ip]['Email Subject'] \
                 + "\r\n" \
-                + generate_email_body(assets[ip], vlan_name, signature)
+                + generate_email_body(assets[ip], vlan_name, signature, plugins, hosts)
     
-    if ip not in ticket_ips: # ticket ips should hold list of ips that already have tickets created for them?
-      if count == 0:
-        server = setup_server_connection(sender)
-        count = count + 1
+    if not tickets.has_ticket(ip, assets[ip]['Plugin IDs']): # skip hosts whose vulnerabilities all have tickets already
       print(message)
-      send_email(assets[ip], sender, receiver, message, server)
-      emails_sent = emails_sent + 1
-      time.sleep(3) #send an email every 3 seconds; 20 emails per minute which is less than the 30 message per minute message rate limit
+      # keyed by the host's findings too, so a host is emailed again once its vulnerabilities change
+      # (and not just because enrichment data such as a last seen time moved)
+      findings = ",".join(sorted(set(assets[ip]['Plugin IDs'])))
+      key = ip + ":" + hashlib.sha256(findings.encode()).hexdigest()
+      pending.append((key, message))
+      queued[key] = (ip, assets[ip]['Plugin IDs'])
     else:
       print("Ticket already opened for %s" %assets[ip]['IP'])
-    
-    if count == 0:
-        server = setup_server_connection(sender)
-        count = count + 1
-    
-    #TODO: test how to fix server connection to send email, for now just printing in terminal
-    print(message)
-    #send_email(assets[ip], sender, receiver, message, server)
-    emails_sent = emails_sent + 1
-    time.sleep(3) #send an email every 3 seconds; 20 emails per minute which is less than the 30 message per minute message rate limit
-  print("%s email(s) sent. Exiting..." %emails_sent)
-  server.quit()
+  
+  # emails are queued on disk first, so a run that dies halfway resumes instead of starting over
+  from outbox import Outbox
+  outbox = Outbox(config_data.get('outbox', './outbox.sqlite3'))
+  for key, message in pending:
+    outbox.enqueue(key, sender, receiver, message)
+  outbox.retry_failed()
+  sent_before = outbox.counts().get('sent', 0)
+  if outbox.next_due() is not None:
+    import asyncio
+    server = setup_server_connection(sender, config_data.get('smtp_connections', 2))
+    counts = asyncio.run(outbox.deliver(server.send, concurrency=server.pool_size, limiter=send_limit,
+                                        on_sent=lambda key: key in queued and tickets.record(*queued[key])))
+    server.close()
+  else:
+    counts = outbox.counts()
+  outbox.close()
+  tickets.close()
+  if hosts:
+    hosts.close()
+  enrichment_cache.close()
+  emails_sent = counts.get('sent', 0) - sent_before
+  print("%s email(s) sent (%.1f per minute), %s failed. Exiting..." % (emails_sent, send_limit.average_rate(), counts.get('failed', 0)))
   
 
 if __name__ == "__main__":
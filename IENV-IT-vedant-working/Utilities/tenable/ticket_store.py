@@ -0,0 +1,78 @@
+#! /usr/bin/python3
+
+import csv
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    ip TEXT NOT NULL,
+    plugin_id TEXT NOT NULL,
+    first_ticketed REAL NOT NULL,
+    last_ticketed REAL NOT NULL,
+    PRIMARY KEY (ip, plugin_id)
+) WITHOUT ROWID;
+"""
+
+# plugin_id used for entries that cover every vulnerability on a host, e.g. imported from ticket_ips.txt
+WHOLE_HOST = ""
+
+
+class TicketStore:
+    """Indexed, persistent record of which IP/plugin pairs already have tickets. """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def import_ip_list(self, filename):
+        # ticket_ips.txt is one or more lines of comma separated ips
+        if not os.path.exists(filename):
+            return 0
+        with open(filename, "r", newline="") as file:
+            ips = [ip.strip() for row in csv.reader(file) for ip in row if ip.strip()]
+        return self.record_hosts(ips)
+
+    def record_hosts(self, ips):
+        now = time.time()
+        with self.db:
+            cursor = self.db.executemany(
+                "INSERT OR IGNORE INTO tickets (ip, plugin_id, first_ticketed, last_ticketed) VALUES (?, ?, ?, ?)",
+                [(ip, WHOLE_HOST, now, now) for ip in ips],
+            )
+        return cursor.rowcount
+
+    def record(self, ip, plugin_ids):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO tickets (ip, plugin_id, first_ticketed, last_ticketed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ip, plugin_id) DO UPDATE SET last_ticketed = excluded.last_ticketed",
+                [(ip, str(plugin_id), now, now) for plugin_id in set(plugin_ids)],
+            )
+
+    def ticketed_plugins(self, ip):
+        # a single primary key range scan, independent of how many tickets are stored
+        rows = self.db.execute("SELECT plugin_id FROM tickets WHERE ip = ?", (ip,)).fetchall()
+        return {row[0] for row in rows}
+
+    def untracked(self, ip, plugin_ids):
+        # plugin ids on this host that no ticket covers yet
+        ticketed = self.ticketed_plugins(ip)
+        if WHOLE_HOST in ticketed:
+            return set()
+        return {str(plugin_id) for plugin_id in plugin_ids} - ticketed
+
+    def has_ticket(self, ip, plugin_ids=None):
+        if plugin_ids is None:
+            return bool(self.ticketed_plugins(ip))
+        return not self.untracked(ip, plugin_ids)
+
+    def __contains__(self, ip):
+        return self.has_ticket(ip)
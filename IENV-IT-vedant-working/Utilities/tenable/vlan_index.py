@@ -0,0 +1,86 @@
+#! /usr/bin/python3
+
+import ipaddress
+from bisect import bisect_right
+
+
+class VlanIndex:
+    """Longest-prefix-match lookup of IP addresses in a set of networks.
+
+    The networks (e.g. InfoBlox.vlans, {"169.237.4.0/24": "ENG-CMPR-SCI-7", ...})
+    are flattened once into sorted, non-overlapping integer ranges where the most
+    specific network wins, so every lookup is a single bisect.
+    """
+
+    def __init__(self, networks):
+        items = networks.items() if hasattr(networks, "items") else networks
+        by_version = {}
+        for network, value in items:
+            try:
+                network = ipaddress.ip_network(network, strict=False)
+            except ValueError:
+                continue
+            by_version.setdefault(network.version, {})[network] = value
+
+        # version -> (range starts, range ends, values)
+        self.tables = {version: self.flatten(nets) for version, nets in by_version.items()}
+        self.size = sum(len(nets) for nets in by_version.values())
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def flatten(networks):
+        # CIDR blocks are either nested or disjoint, so sorting by start then by size
+        # (outer first) and keeping a stack of enclosing networks is enough to split
+        # parents around their children
+        starts, ends, values = [], [], []
+
+        def emit(start, end, value):
+            if start <= end:
+                starts.append(start)
+                ends.append(end)
+                values.append(value)
+
+        nets = sorted(networks.items(), key=lambda item: (int(item[0].network_address), -item[0].num_addresses))
+        stack = []  # (end, value) of the networks enclosing the current position
+        pos = 0
+        for network, value in nets:
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            while stack and stack[-1][0] < start:
+                parent_end, parent_value = stack.pop()
+                emit(pos, parent_end, parent_value)
+                pos = parent_end + 1
+            if stack:
+                emit(pos, start - 1, stack[-1][1])
+            stack.append((end, value))
+            pos = start
+        while stack:
+            parent_end, parent_value = stack.pop()
+            emit(pos, parent_end, parent_value)
+            pos = parent_end + 1
+        return starts, ends, values
+
+    def lookup(self, ip, default=None):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return default
+        table = self.tables.get(address.version)
+        if not table:
+            return default
+        starts, ends, values = table
+        n = int(address)
+        i = bisect_right(starts, n) - 1
+        if i >= 0 and n <= ends[i]:
+            return values[i]
+        return default
+
+    def resolve_many(self, ips, default=None):
+        # {ip: value} for a whole scan; repeated addresses are only resolved once
+        results = {}
+        for ip in ips:
+            if ip not in results:
+                results[ip] = self.lookup(ip, default)
+        return results